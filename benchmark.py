@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2012 Yuri K. Schlesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Times the separate stages of decompiling .rpyc files. Run it with different
+# interpreters (CPython 2, CPython 3, PyPy) on the same files to compare them.
+# JIT-based interpreters need a few warmup rounds before their timings mean anything.
+
+import argparse
+import io
+import platform
+import sys
+import time
+
+import zlib
+
+import unrpyc
+import decompiler
+from decompiler import astdump, magic
+
+def read_file(filename):
+    with open(filename, 'rb') as in_file:
+        return in_file.read()
+
+def load(contents):
+    return unrpyc.read_ast_from_file(io.BytesIO(contents))
+
+def load_interned(contents):
+    return unrpyc.read_ast_from_file(io.BytesIO(contents), string_interner=magic.Interner())
+
+def decompress(contents):
+    start, length = unrpyc.find_slot(contents, 1)
+    return zlib.decompress(contents[start:start + length])
+
+def unpickle(data, accelerate=True):
+    return magic.safe_loads(data, unrpyc.class_factory, {"_ast", "collections"},
+                            encoding="utf-8", errors="surrogateescape", accelerate=accelerate)
+
+def unpickle_python(data):
+    return unpickle(data, accelerate=False)
+
+def decompile(ast):
+    out_file = io.StringIO()
+    decompiler.pprint(out_file, ast)
+    return out_file
+
+def dump(ast):
+    out_file = io.StringIO()
+    astdump.pprint(out_file, ast)
+    return out_file
+
+def measure(func, arg, warmup, rounds):
+    for i in range(warmup):
+        func(arg)
+    timings = []
+    for i in range(rounds):
+        start = time.time()
+        func(arg)
+        timings.append(time.time() - start)
+    return min(timings), sum(timings) / len(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of decompiling .rpyc/.rpymc files")
+
+    parser.add_argument('-w', '--warmup', dest='warmup', type=int, default=3,
+                        help="untimed rounds to run first, so JIT compilers can warm up")
+
+    parser.add_argument('-r', '--rounds', dest='rounds', type=int, default=10,
+                        help="timed rounds per stage")
+
+    parser.add_argument('--intern-strings', dest='intern_strings', action='store_true',
+                        help="also time loading with --intern-strings, and show what it saves")
+
+    parser.add_argument('file', type=str, nargs='+',
+                        help="The files to benchmark.")
+
+    args = parser.parse_args()
+
+    print("%s %s" % (platform.python_implementation(), sys.version.split()[0]))
+    print("%-40s %-12s %12s %12s" % ("file", "stage", "best (ms)", "mean (ms)"))
+    for filename in args.file:
+        contents = read_file(filename)
+        ast = load(contents)
+        data = decompress(contents)
+        stages = [("load", load, contents)]
+        if args.intern_strings:
+            string_interner = magic.Interner()
+            unrpyc.read_ast_from_file(io.BytesIO(contents), string_interner=string_interner)
+            print("%-40s %s" % (filename[-40:], unrpyc.interner_summary(string_interner)))
+            stages.append(("load-intern", load_interned, contents))
+        # unpickling on its own, with the C unpickler (if available) and the python one
+        stages.extend((("unpickle", unpickle, data),
+                       ("unpickle-py", unpickle_python, data),
+                       ("decompile", decompile, ast),
+                       ("dump", dump, ast)))
+        for stage, func, arg in stages:
+            best, mean = measure(func, arg, args.warmup, args.rounds)
+            print("%-40s %-12s %12.2f %12.2f" % (filename[-40:], stage, best * 1000, mean * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -19,34 +19,88 @@
 # SOFTWARE.
 
 from __future__ import unicode_literals
-from util import DecompilerBase, First, WordConcatenator, reconstruct_paraminfo, \
-                 reconstruct_arginfo, string_escape, split_logical_lines, Dispatcher
-from util import say_get_code
+from .util import DecompilerBase, First, WordConcatenator, reconstruct_paraminfo, \
+                  reconstruct_arginfo, string_escape, split_logical_lines, Dispatcher, OutputBuffer
+from .util import say_get_code
 
-from operator import itemgetter
-from StringIO import StringIO
+import sys
+from operator import itemgetter, attrgetter
 
-import magic
-magic.fake_package(b"renpy")
+PY3 = sys.version_info >= (3, 0)
+
+if PY3:
+    unicode = str
+
+from . import magic
+# module names have to be native strings
+magic.fake_package(str("renpy"))
 import renpy
 
-import screendecompiler
-import sl2decompiler
-import testcasedecompiler
-import codegen
-import astdump
+from . import screendecompiler
+from . import sl2decompiler
+from . import testcasedecompiler
+from . import codegen
+from . import astdump
+from . import util
 
-__all__ = ["astdump", "codegen", "magic", "screendecompiler", "sl2decompiler", "testcasedecompiler", "translate", "util", "pprint", "Decompiler"]
+__all__ = ["astdump", "codegen", "magic", "screendecompiler", "sl2decompiler", "testcasedecompiler", "translate", "sourcemap", "util", "pprint", "Decompiler"]
 
 # Main API
 
 def pprint(out_file, ast, indent_level=0,
-           decompile_python=False, printlock=None, translator=None, init_offset=False):
-    Decompiler(out_file, printlock=printlock,
-               decompile_python=decompile_python, translator=translator).dump(ast, indent_level, init_offset)
+           decompile_python=False, printlock=None, translator=None, init_offset=False, processes=1,
+           stream=False, source_map=None):
+    # With stream, the top-level nodes are removed from the list ast while they're printed,
+    # so pass a copy of it if the caller still needs them
+    decompiler = Decompiler(out_file, printlock=printlock,
+                            decompile_python=decompile_python, translator=translator)
+    decompiler.source_map = source_map
+    decompiler.dump(ast, indent_level, init_offset, processes, stream)
+    decompiler.flush()
+    return decompiler.linenumber
 
 # Implementation
 
+def loc_linenumber(ast):
+    return ast.loc[1]
+
+# The decompiler, top-level nodes and assumed init offset of a parallel dump. The processes
+# rendering chunks of it are forked after this is set, so they inherit it instead of having
+# the whole ast pickled to them.
+parallel_job = None
+
+def fork_pool(processes):
+    # Returns None if processes can't be forked on this platform
+    import multiprocessing
+    if PY3:
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        return multiprocessing.get_context("fork").Pool(processes)
+    import os
+    if not hasattr(os, "fork"):
+        return None
+    return multiprocessing.Pool(processes)
+
+def render_chunk(chunk):
+    # Runs in a forked process. Chunk 0 is always the first task a process gets, so it is
+    # rendered from the untouched initial state, like in a serial dump. Every other chunk
+    # starts from the state a top-level node usually leaves behind, with its first line
+    # right after the previous line of output.
+    decompiler, ast, init_offset = parallel_job
+    start, end = chunk
+    if start:
+        decompiler.reset_state(init_offset)
+        decompiler.linenumber = ast[start].linenumber - 1
+    decompiler.out_file = OutputBuffer()
+    if decompiler.source_map is not None:
+        decompiler.source_map = []
+    if util.handler_profile is not None:
+        # only send back what this chunk adds to the profile inherited from the parent
+        util.handler_profile.take()
+    decompiler.print_chunk(ast, start, end)
+    return (decompiler.out_file.getvalue(), decompiler.linenumber, decompiler.is_reset(init_offset),
+            decompiler.source_map, util.handler_profile and util.handler_profile.take())
+
 class Decompiler(DecompilerBase):
     """
     An object which hanldes the decompilation of renpy asts to a given stream
@@ -55,6 +109,7 @@ class Decompiler(DecompilerBase):
     # This dictionary is a mapping of Class: unbount_method, which is used to determine
     # what method to call for which ast class
     dispatch = Dispatcher()
+    print_plans = {}
 
     def __init__(self, out_file=None, decompile_python=False,
                  indentation = '    ', printlock=None, translator=None):
@@ -70,7 +125,7 @@ class Decompiler(DecompilerBase):
         self.init_offset = 0
         self.is_356c6e34_or_later = False
 
-    def dump(self, ast, indent_level=0, init_offset=False):
+    def dump(self, ast, indent_level=0, init_offset=False, processes=1, stream=False):
         if (isinstance(ast, (tuple, list)) and len(ast) > 1 and
             isinstance(ast[-1], renpy.ast.Return) and
             (not hasattr(ast[-1], 'expression') or ast[-1].expression is None) and
@@ -82,28 +137,158 @@ class Decompiler(DecompilerBase):
         if self.translator:
             self.translator.translate_dialogue(ast)
 
+        offset = None
         if init_offset and isinstance(ast, (tuple, list)):
-            self.set_best_init_offset(ast)
+            offset = self.set_best_init_offset(ast)
 
-        # skip_indent_until_write avoids an initial blank line
-        super(Decompiler, self).dump(ast, indent_level, skip_indent_until_write=True)
+        if processes > 1 and indent_level == 0 and isinstance(ast, (tuple, list)):
+            self.dump_parallel(ast, processes, offset or 0)
+        elif stream and indent_level == 0 and isinstance(ast, list):
+            self.dump_stream(ast)
+        else:
+            # skip_indent_until_write avoids an initial blank line
+            super(Decompiler, self).dump(ast, indent_level, skip_indent_until_write=True)
         # if there's anything we wanted to write out but didn't yet, do it now
         for m in self.blank_line_queue:
             m(None)
         self.write("\n# Decompiled by unrpyc: https://github.com/CensoredUsername/unrpyc\n")
         assert not self.missing_init, "A required init, init label, or translate block was missing"
 
-    def print_node(self, ast):
+    def dump_parallel(self, ast, processes, init_offset):
+        """
+        Print the top-level nodes in `ast` like dump does, but split into chunks which are
+        rendered concurrently by `processes` forked processes. Every chunk starts at a label,
+        init or translate block and is rendered as if the nodes before it left no state behind
+        and didn't run past its first line. Chunks for which that turns out not to be true are
+        rendered again here, so the output is identical to that of a serial dump.
+        """
+        self.indent_level = 0
+        self.linenumber = 1
+        self.skip_indent_until_write = True
+
+        global parallel_job
+        chunks = self.split_chunks(ast, processes * 4)
+        parallel_job = (self, ast, init_offset)
+        pool = fork_pool(processes) if len(chunks) > 1 else None
+        if pool is None:
+            parallel_job = None
+            self.print_nodes(ast)
+            return
+
+        try:
+            # is the state we're in the one chunks other than the first one are rendered from
+            reset = False
+            for (start, end), (output, linenumber, ends_reset, source_map, handler_stats) in zip(
+                    chunks, pool.imap(render_chunk, chunks)):
+                if handler_stats:
+                    # the chunk was rendered, whether it's used or not
+                    util.handler_profile.update(handler_stats)
+                if ends_reset and (start == 0 or reset and self.linenumber < ast[start].linenumber):
+                    if start:
+                        # the blank lines advance_to_line would have written
+                        self.out_file.write("\n" * (ast[start].linenumber - 1 - self.linenumber))
+                    self.out_file.write(output)
+                    if source_map is not None:
+                        self.source_map.extend(source_map)
+                    self.reset_state(init_offset)
+                    self.linenumber = linenumber
+                    reset = True
+                else:
+                    self.print_chunk(ast, start, end)
+                    reset = self.is_reset(init_offset)
+        finally:
+            parallel_job = None
+            pool.terminate()
+            pool.join()
+
+    def dump_stream(self, ast):
+        """
+        Print the top-level nodes in `ast` like dump does, but write each of them out to the file
+        once it has been printed, and then remove it from `ast` (keeping the two nodes before
+        the current one, which some nodes look back at). This way little more than the output of
+        a single top-level node is buffered, and nodes can be freed once they've been printed.
+        """
+        self.indent_level = 0
+        self.linenumber = 1
+        self.skip_indent_until_write = True
+
+        self.block_stack.append(ast)
+        self.index_stack.append(0)
+        for i in range(len(ast)):
+            self.index_stack[-1] = i
+            self.print_node(ast[i])
+            # writing out every small node on its own is slow, so wait for a bit of output
+            if len(self.out_file.fragments) >= 4096:
+                self.flush()
+            if i >= 2:
+                ast[i - 2] = None
+        self.block_stack.pop()
+        self.index_stack.pop()
+
+    def split_chunks(self, ast, count):
+        # Returns (start, end) ranges of the top-level nodes in ast, aiming for count chunks.
+        size = max(len(ast) // count, 1)
+        chunks = []
+        start = 0
+        for i, node in enumerate(ast):
+            if (i - start >= size and hasattr(node, 'linenumber') and
+                    isinstance(node, (renpy.ast.Label, renpy.ast.Init, renpy.ast.Translate))):
+                chunks.append((start, i))
+                start = i
+        chunks.append((start, len(ast)))
+        return chunks
+
+    def print_chunk(self, ast, start, end):
+        # Prints the nodes of the top-level block ast from start up to end
+        self.block_stack.append(ast)
+        self.index_stack.append(start)
+        for i in range(start, end):
+            self.index_stack[-1] = i
+            self.print_node(ast[i])
+        self.block_stack.pop()
+        self.index_stack.pop()
+
+    def reset_state(self, init_offset):
+        # The state between two top-level nodes when nothing is carried over from one to the next
+        self.skip_indent_until_write = False
+        self.indent_level = 0
+        self.blank_line_queue = []
+        self.paired_with = False
+        self.say_inside_menu = None
+        self.label_inside_menu = None
+        self.in_init = False
+        self.missing_init = False
+        self.init_offset = init_offset
+
+    def is_reset(self, init_offset):
+        return (not self.skip_indent_until_write and self.indent_level == 0 and
+                not self.blank_line_queue and self.paired_with is False and
+                self.say_inside_menu is None and self.label_inside_menu is None and
+                not self.in_init and not self.missing_init and self.init_offset == init_offset)
+
+    def map_node(self, ast, linenumber):
+        # A label is part of its own context in the source map
+        if isinstance(ast, renpy.ast.Label):
+            source_map_label = self.source_map_label
+            self.source_map_label = ast.name
+            super(Decompiler, self).map_node(ast, linenumber)
+            self.source_map_label = source_map_label
+        else:
+            super(Decompiler, self).map_node(ast, linenumber)
+
+    def make_print_plan(self, ast):
         # We special-case line advancement for TranslateString in its print
         # method, so don't advance lines for it here.
         if hasattr(ast, 'linenumber') and not isinstance(ast, renpy.ast.TranslateString):
-            self.advance_to_line(ast.linenumber)
+            linenumber = attrgetter('linenumber')
         # It doesn't matter what line "block:" is on. The loc of a RawBlock
         # refers to the first statement inside the block, which we advance
         # to from print_atl.
         elif hasattr(ast, 'loc') and not isinstance(ast, renpy.atl.RawBlock):
-            self.advance_to_line(ast.loc[1])
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+            linenumber = loc_linenumber
+        else:
+            linenumber = None
+        return linenumber, self.dispatch.get(type(ast), type(self).print_unknown)
 
     # ATL printing functions
 
@@ -111,7 +296,7 @@ class Decompiler(DecompilerBase):
         with self.increase_indent():
             self.advance_to_line(ast.loc[1])
             if ast.statements:
-                self.print_nodes(ast.statements)
+                yield self.walk_nodes(ast.statements)
             # If a statement ends with a colon but has no block after it, loc will
             # get set to ('', 0). That isn't supposed to be valid syntax, but it's
             # the only thing that can generate that.
@@ -184,14 +369,14 @@ class Decompiler(DecompilerBase):
     def print_atl_rawblock(self, ast):
         self.indent()
         self.write("block:")
-        self.print_atl(ast)
+        yield self.print_atl(ast)
 
     @dispatch(renpy.atl.RawChild)
     def print_atl_rawchild(self, ast):
         for child in ast.children:
             self.indent()
             self.write("contains:")
-            self.print_atl(child)
+            yield self.print_atl(child)
 
     @dispatch(renpy.atl.RawChoice)
     def print_atl_rawchoice(self, ast):
@@ -201,7 +386,7 @@ class Decompiler(DecompilerBase):
             if chance != "1.0":
                 self.write(" %s" % chance)
             self.write(":")
-            self.print_atl(block)
+            yield self.print_atl(block)
         if (self.index + 1 < len(self.block) and
             isinstance(self.block[self.index + 1], renpy.atl.RawChoice)):
             self.indent()
@@ -228,14 +413,14 @@ class Decompiler(DecompilerBase):
                                   key=lambda i: i[1].loc[1]):
             self.indent()
             self.write("on %s:" % name)
-            self.print_atl(block)
+            yield self.print_atl(block)
 
     @dispatch(renpy.atl.RawParallel)
     def print_atl_rawparallel(self, ast):
         for block in ast.blocks:
             self.indent()
             self.write("parallel:")
-            self.print_atl(block)
+            yield self.print_atl(block)
         if (self.index + 1 < len(self.block) and
             isinstance(self.block[self.index + 1], renpy.atl.RawParallel)):
             self.indent()
@@ -290,7 +475,7 @@ class Decompiler(DecompilerBase):
         else:
             if hasattr(ast, "atl") and ast.atl is not None:
                 self.write(":")
-                self.print_atl(ast.atl)
+                yield self.print_atl(ast.atl)
 
     @dispatch(renpy.ast.Transform)
     def print_transform(self, ast):
@@ -309,7 +494,7 @@ class Decompiler(DecompilerBase):
 
         if hasattr(ast, "atl") and ast.atl is not None:
             self.write(":")
-            self.print_atl(ast.atl)
+            yield self.print_atl(ast.atl)
 
     # Directing related functions
 
@@ -327,7 +512,7 @@ class Decompiler(DecompilerBase):
 
         if hasattr(ast, "atl") and ast.atl is not None:
             self.write(":")
-            self.print_atl(ast.atl)
+            yield self.print_atl(ast.atl)
 
     @dispatch(renpy.ast.ShowLayer)
     def print_showlayer(self, ast):
@@ -339,7 +524,7 @@ class Decompiler(DecompilerBase):
 
         if hasattr(ast, "atl") and ast.atl is not None:
             self.write(":")
-            self.print_atl(ast.atl)
+            yield self.print_atl(ast.atl)
 
     @dispatch(renpy.ast.Scene)
     def print_scene(self, ast):
@@ -362,7 +547,7 @@ class Decompiler(DecompilerBase):
 
         if hasattr(ast, "atl") and ast.atl is not None:
             self.write(":")
-            self.print_atl(ast.atl)
+            yield self.print_atl(ast.atl)
 
     @dispatch(renpy.ast.Hide)
     def print_hide(self, ast):
@@ -419,24 +604,24 @@ class Decompiler(DecompilerBase):
         self.indent()
 
         # It's possible that we're an "init label", not a regular label. There's no way to know
-        # if we are until we parse our children, so temporarily redirect all of our output until
-        # that's done, so that we can squeeze in an "init " if we are.
-        out_file = self.out_file
-        self.out_file = StringIO()
+        # if we are until we parse our children, so remember where our output starts, so that
+        # we can squeeze in an "init " there if we are.
+        mark = self.out_file.mark()
         missing_init = self.missing_init
         self.missing_init = False
+        source_map_label = self.source_map_label
+        self.source_map_label = ast.name
         try:
             self.write("label %s%s%s:" % (
                 ast.name,
                 reconstruct_paraminfo(ast.parameters) if hasattr(ast, 'parameters') else '',
                 " hide" if hasattr(ast, 'hide') and ast.hide else ""))
-            self.print_nodes(ast.block, 1)
+            yield self.walk_nodes(ast.block, 1)
         finally:
             if self.missing_init:
-                out_file.write("init ")
+                self.out_file.insert(mark, "init ")
             self.missing_init = missing_init
-            out_file.write(self.out_file.getvalue())
-            self.out_file = out_file
+            self.source_map_label = source_map_label
 
     @dispatch(renpy.ast.Jump)
     def print_jump(self, ast):
@@ -486,7 +671,7 @@ class Decompiler(DecompilerBase):
 
         for i, (condition, block) in enumerate(ast.entries):
             # The non-Unicode string "True" is the condition for else:.
-            if (i + 1) == len(ast.entries) and not isinstance(condition, unicode):
+            if (i + 1) == len(ast.entries) and not self.is_user_condition(condition):
                 self.indent()
                 self.write("else:")
             else:
@@ -495,14 +680,14 @@ class Decompiler(DecompilerBase):
                 self.indent()
                 self.write(statement() % condition)
 
-            self.print_nodes(block, 1)
+            yield self.walk_nodes(block, 1)
 
     @dispatch(renpy.ast.While)
     def print_while(self, ast):
         self.indent()
         self.write("while %s:" % ast.condition)
 
-        self.print_nodes(ast.block, 1)
+        yield self.walk_nodes(ast.block, 1)
 
     @dispatch(renpy.ast.Pass)
     def print_pass(self, ast):
@@ -519,6 +704,12 @@ class Decompiler(DecompilerBase):
         self.indent()
         self.write("pass")
 
+    def is_user_condition(self, condition):
+        # Ren'Py uses the non-Unicode string "True" for conditions which weren't given in the
+        # source. On Python 3 it loads as a regular string, so compare the value as well.
+        return isinstance(condition, unicode) and (
+            not PY3 or isinstance(condition, renpy.ast.PyExpr) or condition != "True")
+
     def should_come_before(self, first, second):
         return first.linenumber < second.linenumber
 
@@ -547,6 +738,8 @@ class Decompiler(DecompilerBase):
             # more than one priority specification versus not setting one.
             if votes.get(0, 0) + 1 < votes[winner]:
                 self.set_init_offset(winner)
+                return winner
+        return None
 
     def set_init_offset(self, offset):
         def do_set_init_offset(linenumber):
@@ -587,14 +780,14 @@ class Decompiler(DecompilerBase):
                 (ast.priority == (500 if self.is_356c6e34_or_later else 990) + self.init_offset and isinstance(ast.block[0], renpy.ast.Image))) and not (
                 self.should_come_before(ast, ast.block[0])):
                 # If they fulfill this criteria we just print the contained statement
-                self.print_nodes(ast.block)
+                yield self.walk_nodes(ast.block)
 
             # translatestring statements are split apart and put in an init block.
             elif (len(ast.block) > 0 and
                     ast.priority == self.init_offset and
                     all(isinstance(i, renpy.ast.TranslateString) for i in ast.block) and
                     all(i.language == ast.block[0].language for i in ast.block[1:])):
-                self.print_nodes(ast.block)
+                yield self.walk_nodes(ast.block)
 
             else:
                 self.indent()
@@ -605,10 +798,10 @@ class Decompiler(DecompilerBase):
                 if len(ast.block) == 1 and not self.should_come_before(ast, ast.block[0]):
                     self.write(" ")
                     self.skip_indent_until_write = True
-                    self.print_nodes(ast.block)
+                    yield self.walk_nodes(ast.block)
                 else:
                     self.write(":")
-                    self.print_nodes(ast.block, 1)
+                    yield self.walk_nodes(ast.block, 1)
         finally:
             self.in_init = in_init
 
@@ -627,6 +820,8 @@ class Decompiler(DecompilerBase):
 
         with self.increase_indent():
             if self.say_inside_menu is not None:
+                if self.source_map is not None:
+                    self.map_node(self.say_inside_menu, None)
                 self.print_say(self.say_inside_menu, inmenu=True)
                 self.say_inside_menu = None
 
@@ -647,7 +842,7 @@ class Decompiler(DecompilerBase):
                 if self.translator:
                     label = self.translator.strings.get(label, label)
 
-                if isinstance(condition, unicode):
+                if self.is_user_condition(condition):
                     self.advance_to_line(condition.linenumber)
                 self.indent()
                 self.write('"%s"' % string_escape(label))
@@ -656,10 +851,10 @@ class Decompiler(DecompilerBase):
                     self.write(reconstruct_arginfo(arguments))
 
                 if block is not None:
-                    if isinstance(condition, unicode):
+                    if self.is_user_condition(condition):
                         self.write(" if %s" % condition)
                     self.write(":")
-                    self.print_nodes(block, 1)
+                    yield self.walk_nodes(block, 1)
 
     # Programming related functions
 
@@ -729,6 +924,9 @@ class Decompiler(DecompilerBase):
         if (not inmenu and self.index + 1 < len(self.block) and
             self.say_belongs_to_menu(ast, self.block[self.index + 1])):
             self.say_inside_menu = ast
+            if self.source_map is not None:
+                # print_menu maps it again on the line it actually gets printed on
+                self.source_map.pop()
             return
         self.indent()
         self.write(say_get_code(ast, inmenu))
@@ -740,7 +938,7 @@ class Decompiler(DecompilerBase):
 
         if hasattr(ast, "block") and ast.block:
             with self.increase_indent():
-                self.print_lex(ast.block)
+                yield self.print_lex(ast.block)
 
     def print_lex(self, lex):
         for file, linenumber, content, block in lex:
@@ -749,7 +947,7 @@ class Decompiler(DecompilerBase):
             self.write(content)
             if block:
                 with self.increase_indent():
-                    self.print_lex(block)
+                    yield self.print_lex(block)
 
     @dispatch(renpy.ast.Style)
     def print_style(self, ast):
@@ -771,7 +969,7 @@ class Decompiler(DecompilerBase):
             if ast.variant.linenumber not in keywords:
                 keywords[ast.variant.linenumber] = WordConcatenator(False)
             keywords[ast.variant.linenumber].append("variant %s" % ast.variant)
-        for key, value in ast.properties.iteritems():
+        for key, value in ast.properties.items():
             if value.linenumber not in keywords:
                 keywords[value.linenumber] = WordConcatenator(False)
             keywords[value.linenumber].append("%s %s" % (key, value))
@@ -797,7 +995,7 @@ class Decompiler(DecompilerBase):
         self.indent()
         self.write("translate %s %s:" % (ast.language or "None", ast.identifier))
 
-        self.print_nodes(ast.block, 1)
+        yield self.walk_nodes(ast.block, 1)
 
     @dispatch(renpy.ast.EndTranslate)
     def print_endtranslate(self, ast):
@@ -836,7 +1034,7 @@ class Decompiler(DecompilerBase):
             # Ren'Py counts the TranslateBlock from "translate python" and "translate style" as an Init.
             self.in_init = True
         try:
-            self.print_nodes(ast.block)
+            yield self.walk_nodes(ast.block)
         finally:
             self.in_init = in_init
 
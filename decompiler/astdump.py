@@ -22,10 +22,17 @@ from __future__ import unicode_literals
 
 import sys
 import inspect
-import codegen
 import ast as py_ast
 import renpy
 
+from . import codegen
+
+PY3 = sys.version_info >= (3, 0)
+
+if PY3:
+    unicode = str
+    long = int
+
 def pprint(out_file, ast, decompile_python=False, comparable=False, no_pyexpr=False):
     # The main function of this module, a wrapper which sets
     # the config and creates the AstDumper instance
@@ -65,7 +72,7 @@ class AstDumper(object):
             self.print_pyexpr(ast)
         elif isinstance(ast, dict):
             self.print_dict(ast)
-        elif isinstance(ast, (str, unicode)):
+        elif isinstance(ast, (bytes, unicode)):
             self.print_string(ast)
         elif isinstance(ast, (int, long, bool)) or ast is None:
             self.print_other(ast)
@@ -222,10 +229,13 @@ class AstDumper(object):
     def print_string(self, ast):
         # prints the representation of a string. If there are newlines in this string,
         # it will print it as a docstring.
-        if b'\n' in ast:
-            astlist = ast.split(b'\n')
-            if isinstance(ast, unicode):
+        newline = b'\n' if isinstance(ast, bytes) else '\n'
+        if newline in ast:
+            astlist = ast.split(newline)
+            if isinstance(ast, unicode) and not PY3:
                 self.p('u')
+            elif isinstance(ast, bytes) and PY3:
+                self.p('b')
             self.p('"""')
             self.p(self.escape_string(astlist.pop(0)))
             for i, item in enumerate(astlist):
@@ -240,9 +250,9 @@ class AstDumper(object):
     def escape_string(self, string):
         # essentially the representation of a string without the surrounding quotes
         if isinstance(string, unicode):
-            return repr(string)[2:-1]
-        elif isinstance(string, str):
-            return repr(string)[1:-1]
+            return repr(string)[1:-1] if PY3 else repr(string)[2:-1]
+        elif isinstance(string, bytes):
+            return repr(string)[2:-1] if PY3 else repr(string)[1:-1]
         else:
             return string
 
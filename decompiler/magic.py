@@ -9,25 +9,36 @@ PY2 = not PY3
 
 import types
 import pickle
+import pickletools
 import struct
+import timeit
 
 if PY3:
+    import copyreg
     from io import BytesIO as StringIO
+    from importlib.machinery import ModuleSpec
 else:
+    import copy_reg as copyreg
     from cStringIO import StringIO
 
 __all__ = [
     "load", "loads", "safe_load", "safe_loads", "safe_dump", "safe_dumps",
     "fake_package", "remove_fake_package",
     "FakeModule", "FakePackage", "FakePackageLoader",
-    "FakeClassType", "FakeClassFactory",
+    "FakeClassType", "FakeClassFactory", "Interner",
     "FakeClass", "FakeStrict", "FakeWarning", "FakeIgnore",
-    "FakeUnpicklingError", "FakeUnpickler", "SafeUnpickler",
+    "FakeUnpicklingError", "UnpicklingLimitError", "FakeUnpickler", "SafeUnpickler", "CSafeUnpickler",
+    "ProfilingUnpickler", "UnpicklingProfile", "profile_loads",
     "SafePickler"
 ]
 
 # Fake class implementation
 
+# Results of the subclass checks of FakeClassType and FakeModule, which compare names all the way
+# up the bases of the checked class. Keyed by the ids of both classes, and cleared whenever a fake
+# class is created.
+_subclass_cache = {}
+
 class FakeClassType(type):
     """
     The metaclass used to create fake classes. To support comparisons between
@@ -75,6 +86,7 @@ class FakeClassType(type):
 
     def __init__(self, name, bases, attributes, module=None):
         type.__init__(self, name, bases, attributes)
+        _subclass_cache.clear()
 
     # comparison logic
 
@@ -96,17 +108,36 @@ class FakeClassType(type):
         return self.__subclasscheck__(instance.__class__)
 
     def __subclasscheck__(self, subclass):
-        return (self == subclass or
-                (bool(subclass.__bases__) and
-                 any(self.__subclasscheck__(base) for base in subclass.__bases__)))
+        key = (id(self), id(subclass))
+        cached = _subclass_cache.get(key)
+        if cached is None:
+            result = (self == subclass or
+                      (bool(subclass.__bases__) and
+                       any(self.__subclasscheck__(base) for base in subclass.__bases__)))
+            # keep both alive, so their ids can't be reused while the result is cached
+            cached = _subclass_cache[key] = (self, subclass, result)
+        return cached[2]
 
 # PY2 doesn't like the PY3 way of metaclasses and PY3 doesn't support the PY2 way
 # so we call the metaclass directly
 FakeClass = FakeClassType("FakeClass", (), {"__doc__": """
 A barebones instance of :class:`FakeClassType`. Inherit from this to create fake classes.
-"""}, module=__name__)
+""", "__slots__": ()}, module=__name__)
+
+# The fake base classes don't have an instance dict of their own, so subclasses can be
+# compact by defining __slots__. Subclasses without __slots__ get a dict as usual.
+
+def _update_state(self, state):
+    # Attributes which have a slot have to be set one by one, __dict__.update would hide them
+    if type(self).__slots__:
+        for key, value in state.items():
+            setattr(self, key, value)
+    else:
+        self.__dict__.update(state)
 
 class FakeStrict(FakeClass, object):
+    __slots__ = ()
+
     def __new__(cls, *args, **kwargs):
         self = FakeClass.__new__(cls)
         if args or kwargs:
@@ -126,12 +157,14 @@ class FakeStrict(FakeClass, object):
             if not isinstance(state, dict):
                 raise FakeUnpicklingError("{0}.__setstate__() got unexpected arguments {1}".format(self.__class__, state))
             else:
-                self.__dict__.update(state)
+                _update_state(self, state)
 
         if slotstate:
-            self.__dict__.update(slotstate)
+            _update_state(self, slotstate)
 
 class FakeWarning(FakeClass, object):
+    __slots__ = ()
+
     def __new__(cls, *args, **kwargs):
         self = FakeClass.__new__(cls)
         if args or kwargs:
@@ -153,12 +186,14 @@ class FakeWarning(FakeClass, object):
                 print("{0}.__setstate__() got unexpected arguments {1}".format(self.__class__, state))
                 self._setstate_args = state
             else:
-                self.__dict__.update(state)
+                _update_state(self, state)
 
         if slotstate:
-            self.__dict__.update(slotstate)
+            _update_state(self, slotstate)
 
 class FakeIgnore(FakeClass, object):
+    __slots__ = ()
+
     def __new__(cls, *args, **kwargs):
         self = FakeClass.__new__(cls)
         if args:
@@ -180,10 +215,10 @@ class FakeIgnore(FakeClass, object):
             if not isinstance(state, dict):
                 self._setstate_args = state
             else:
-                self.__dict__.update(state)
+                _update_state(self, state)
 
         if slotstate:
-            self.__dict__.update(slotstate)
+            _update_state(self, slotstate)
 
 class FakeClassFactory(object):
     """
@@ -191,7 +226,7 @@ class FakeClassFactory(object):
     based on the passed arguments.
     """
 
-    def __init__(self, special_cases=(), default_class=FakeStrict):
+    def __init__(self, special_cases=(), default_class=FakeStrict, slots=None, setstates=None):
         """
         *special_cases* should be an iterable containing fake classes which should be treated
         as special cases during the fake unpickling process. This way you can specify custom methods
@@ -214,9 +249,21 @@ class FakeClassFactory(object):
 
         Alternatively they can also be instantiated using :class:`FakeClassType` directly::
            special_cases = [FakeClassType(c.__name__, c.__bases__, c.__dict__, c.__module__)]
+
+        *slots* can be a mapping of ``(module, name)`` tuples to the attribute names the
+        instances of that class are known to have. The fake classes generated for these get
+        :attr:`__slots__` for them, which makes their instances a lot smaller. Attributes which
+        aren't in the list still end up in an instance dict, so any list works, it's just less
+        compact.
+
+        *setstates* can be a mapping of ``(module, name)`` tuples to :meth:`__setstate__`
+        implementations for the fake classes generated for those classes, to replace the
+        generic one of *default_class* by one which is specialized for their state.
         """
         self.special_cases = dict(((i.__module__, i.__name__), i) for i in special_cases)
         self.default = default_class
+        self.slots = slots or {}
+        self.setstates = setstates or {}
 
         self.class_cache = {}
 
@@ -238,11 +285,85 @@ class FakeClassFactory(object):
 
         if not klass:
             # generate a new class def which inherits from the default fake class
-            klass = type(name, (self.default,), {"__module__": module})
+            attributes = {"__module__": module}
+            slots = self.slots.get((module, name), None)
+            if slots is not None:
+                attributes["__slots__"] = tuple(slots) + ("__dict__",)
+            setstate = self.setstates.get((module, name), None)
+            if setstate is not None:
+                attributes["__setstate__"] = setstate
+            klass = type(name, (self.default,), attributes)
 
         self.class_cache[(module, name)] = klass
         return klass
 
+# Interning
+
+class Interner(object):
+    """
+    A flyweight table for immutable values. Calling it with a string, or a tuple containing
+    strings, numbers and such tuples, returns an equal value of the same type, which is shared
+    with all earlier equal values it was called with. Anything else is returned unchanged.
+
+    Subclasses of the string types (like fake classes inheriting from str) are never interned.
+    Values are only considered equal if their types match, so Python 2 str and unicode
+    values, or ``1`` and ``True`` in tuples, never replace each other.
+
+    :attr:`saved` counts the number of bytes taken by the duplicates which were replaced,
+    and :attr:`hits` their number. On interpreters which can't tell the size of an object
+    (like PyPy), :attr:`saved` is None.
+    """
+    def __init__(self):
+        self.table = {}
+        self.saved = 0
+        self.hits = 0
+
+    def clear(self):
+        self.table.clear()
+        self.saved = 0
+        self.hits = 0
+
+    def __call__(self, value):
+        kind = type(value)
+        if kind is tuple:
+            items = tuple([self(i) for i in value])
+            if all(a is b for a, b in zip(items, value)):
+                items = value
+            key = self._key(items)
+            if key is None:
+                # can't be keyed by value, but the items can still be shared
+                return items
+        elif kind in _INTERN_STRING_TYPES:
+            items = value
+            key = (kind, value)
+        else:
+            return value
+
+        canonical = self.table.get(key, None)
+        if canonical is None:
+            canonical = self.table[key] = items
+        elif canonical is not value:
+            self.hits += 1
+            if self.saved is not None:
+                try:
+                    self.saved += sys.getsizeof(value)
+                except TypeError:
+                    self.saved = None
+        return canonical
+
+    def _key(self, value):
+        # a key which includes the types of everything in value, or None if it can't be interned
+        kind = type(value)
+        if kind is tuple:
+            keys = tuple([self._key(i) for i in value])
+            return None if None in keys else (kind, keys)
+        elif kind in _INTERN_SCALAR_TYPES:
+            return (kind, value)
+        return None
+
+_INTERN_STRING_TYPES = (bytes, str) if PY3 else (str, unicode)
+_INTERN_SCALAR_TYPES = _INTERN_STRING_TYPES + (int, bool, float, type(None)) + (() if PY3 else (long,))
+
 # Fake module implementation
 
 class FakeModule(types.ModuleType):
@@ -343,9 +464,15 @@ class FakeModule(types.ModuleType):
         return self.__subclasscheck__(instance.__class__)
 
     def __subclasscheck__(self, subclass):
-        return (self == subclass or
-                (bool(subclass.__bases__) and
-                 any(self.__subclasscheck__(base) for base in subclass.__bases__)))
+        key = (id(self), id(subclass))
+        cached = _subclass_cache.get(key)
+        if cached is None:
+            result = (self == subclass or
+                      (bool(subclass.__bases__) and
+                       any(self.__subclasscheck__(base) for base in subclass.__bases__)))
+            # keep both alive, so their ids can't be reused while the result is cached
+            cached = _subclass_cache[key] = (self, subclass, result)
+        return cached[2]
 
 class FakePackage(FakeModule):
     """
@@ -363,6 +490,11 @@ class FakePackage(FakeModule):
         raise TypeError("'{0}' FakePackage object is not callable".format(self.__name__))
 
     def __getattr__(self, name):
+        # Don't turn special attributes which the import machinery and other
+        # introspection code looks for into fake submodules
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError(name)
+
         modname = self.__name__ + "." + name
         mod = sys.modules.get(modname, None)
         if mod is None:
@@ -397,6 +529,20 @@ class FakePackageLoader(object):
     def load_module(self, fullname):
         return FakePackage(fullname)
 
+    # PEP 451 loader protocol, which is the only one supported by Python 3.12 and later
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname == self.root or fullname.startswith(self.root + "."):
+            return ModuleSpec(fullname, self, is_package=True)
+        else:
+            return None
+
+    def create_module(self, spec):
+        return FakePackage(spec.name)
+
+    def exec_module(self, module):
+        pass
+
 # Fake unpickler implementation
 
 class FakeUnpicklingError(pickle.UnpicklingError):
@@ -406,6 +552,13 @@ class FakeUnpicklingError(pickle.UnpicklingError):
     """
     pass
 
+class UnpicklingLimitError(pickle.UnpicklingError):
+    """
+    Error raised when a pickle stream exceeds one of the resource limits given to
+    :class:`SafeUnpickler`. It inherits from :exc:`pickle.UnpicklingError`.
+    """
+    pass
+
 class FakeUnpickler(pickle.Unpickler if PY2 else pickle._Unpickler):
     """
     A forgiving unpickler. On uncountering references to class definitions
@@ -486,15 +639,37 @@ class SafeUnpickler(FakeUnpickler):
     It should be noted though that when the unpickler tries to get a nonexistent
     attribute of a safe module, an :exc:`AttributeError` will be raised.
 
+    The optional keyword arguments *max_objects*, *max_length* and *max_depth* limit the
+    resources a pickle stream can use: the number of objects it creates (every string,
+    number, container, class and instance counts, references to memoized objects and
+    ``None``/``True``/``False`` don't), the length of
+    any list, tuple, dict or set it builds and how deeply the objects in the result nest
+    (the longest chain of containers and instances in it, also through objects which are
+    shared or referred to from the memo). When one of the first two limits is exceeded, an
+    :exc:`UnpicklingLimitError` is raised right away. The depth of the result is checked
+    when the end of the stream is reached, since objects can still be nested into each
+    other until then. Streams can still contain large strings, so their size should be
+    limited by the file object they're read from.
+
     This inherits from :class:`FakeUnpickler`
     """
     def __init__(self, file, class_factory=None, safe_modules=(),
-                 use_copyreg=False, encoding="bytes", errors="strict"):
+                 use_copyreg=False, encoding="bytes", errors="strict",
+                 max_objects=None, max_length=None, max_depth=None):
         FakeUnpickler.__init__(self, file, class_factory, encoding=encoding, errors=errors)
         # A set of modules which are safe to load
         self.safe_modules = set(safe_modules)
         self.use_copyreg = use_copyreg
 
+        self.max_objects = max_objects
+        self.max_length = max_length
+        self.max_depth = max_depth
+        if max_objects is not None or max_length is not None or max_depth is not None:
+            # The limits are checked by a wrapped copy of the dispatch table, so unpickling
+            # without limits isn't slowed down
+            self.objects = 0
+            self.dispatch = _limited_dispatch(self.__class__)
+
     def find_class(self, module, name):
         if module in self.safe_modules:
             __import__(module)
@@ -509,7 +684,364 @@ class SafeUnpickler(FakeUnpickler):
         if self.use_copyreg:
             return FakeUnpickler.get_extension(self, code)
         else:
-            return self.class_factory("extension_code_{0}".format(code), "copyreg")
+            # like the original, this pushes the result on the stack instead of returning it
+            self.append(self.class_factory("extension_code_{0}".format(code), "copyreg"))
+
+# Resource limits
+
+# opcodes which leave something on the stack without creating a new object: references
+# to existing objects, singletons, and opcodes that change or memoize the top of the stack
+_NONCREATING_OPCODES = ("GET", "BINGET", "LONG_BINGET", "DUP", "MARK",
+                        "PUT", "BINPUT", "LONG_BINPUT", "MEMOIZE", "BUILD",
+                        "APPEND", "APPENDS", "SETITEM", "SETITEMS", "ADDITEMS",
+                        "NONE", "NEWTRUE", "NEWFALSE")
+# opcodes which leave a grown or new container on top of the stack
+_CONTAINER_OPCODES = ("APPEND", "APPENDS", "SETITEM", "SETITEMS", "ADDITEMS",
+                      "LIST", "TUPLE", "DICT", "FROZENSET")
+
+# leaves of an object tree, which can't contain other objects
+_LEAF_TYPES = frozenset(_INTERN_SCALAR_TYPES + (complex,))
+_LEAF_CLASSES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+# names of the slots of every class, including those of its bases
+_slot_names = {}
+
+def _contents(obj):
+    # the objects directly contained in obj, or None if it can't contain any
+    kind = type(obj)
+    if kind in _LEAF_TYPES or isinstance(obj, _LEAF_CLASSES):
+        return None
+    if kind in (list, tuple, set, frozenset):
+        return obj
+    if kind is dict:
+        return list(obj.keys()) + list(obj.values())
+
+    contents = []
+    if isinstance(obj, dict):
+        contents.extend(obj.keys())
+        contents.extend(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        contents.extend(obj)
+
+    names = _slot_names.get(kind, None)
+    if names is None:
+        names = []
+        for klass in kind.__mro__:
+            slots = klass.__dict__.get("__slots__", ())
+            names.extend([slots] if isinstance(slots, str) else slots)
+        names = _slot_names[kind] = [name for name in names if name not in ("__dict__", "__weakref__")]
+    contents.extend([getattr(obj, name) for name in names if hasattr(obj, name)])
+    state = getattr(obj, "__dict__", None)
+    if isinstance(state, dict):
+        contents.extend(state.values())
+    return contents
+
+def _too_deep(max_depth):
+    return UnpicklingLimitError("Pickle nests deeper than the limit of {0}".format(max_depth))
+
+def _check_nesting(obj, max_depth):
+    # Raises UnpicklingLimitError if more than max_depth containers and instances nest in obj.
+    # Objects contained in several others are walked once, remembering how many levels they
+    # contain themselves. References back to an object on the current path are ignored.
+    contents = _contents(obj)
+    if contents is None:
+        return
+    if max_depth < 1:
+        raise _too_deep(max_depth)
+    heights = {}
+    # the path to the current object, as lists of [object, iterator over its contents, height]
+    path = [[obj, iter(contents), 1]]
+    on_path = set([id(obj)])
+    while path:
+        frame = path[-1]
+        for item in frame[1]:
+            key = id(item)
+            if key in on_path:
+                continue
+            height = heights.get(key, None)
+            if height is None:
+                contents = _contents(item)
+                if contents is None:
+                    continue
+                if len(path) >= max_depth:
+                    raise _too_deep(max_depth)
+                on_path.add(key)
+                path.append([item, iter(contents), 1])
+                break
+            if len(path) + height > max_depth:
+                raise _too_deep(max_depth)
+            frame[2] = max(frame[2], height + 1)
+        else:
+            path.pop()
+            on_path.remove(id(frame[0]))
+            heights[id(frame[0])] = frame[2]
+            if path:
+                path[-1][2] = max(path[-1][2], frame[2] + 1)
+
+def _limited(opcode, func):
+    # wraps the dispatch function of an opcode to check the limits of the unpickler
+    stops = opcode.name == "STOP"
+    creates = bool(opcode.stack_after) and opcode.name not in _NONCREATING_OPCODES
+    grows = opcode.name in _CONTAINER_OPCODES
+
+    def limited(self):
+        if stops and self.max_depth is not None:
+            _check_nesting(self.stack[-1], self.max_depth)
+
+        if creates:
+            self.objects += 1
+            if self.max_objects is not None and self.objects > self.max_objects:
+                raise UnpicklingLimitError(
+                    "Pickle creates more objects than the limit of {0}".format(self.max_objects))
+
+        func(self)
+
+        if grows and self.max_length is not None:
+            try:
+                length = len(self.stack[-1])
+            except TypeError:
+                return
+            if length > self.max_length:
+                raise UnpicklingLimitError(
+                    "Pickle builds a container longer than the limit of {0}".format(self.max_length))
+    return limited
+
+def _opcode_key(opcode):
+    # the keys of the unpickler's dispatch table
+    return opcode if PY2 else opcode[0]
+
+_limited_dispatches = {}
+
+def _limited_dispatch(cls):
+    # the dispatch table of cls with all opcodes wrapped by _limited, created once per class
+    dispatch = _limited_dispatches.get(cls, None)
+    if dispatch is None:
+        dispatch = dict(cls.dispatch)
+        for opcode in pickletools.opcodes:
+            key = _opcode_key(opcode.code if PY2 else opcode.code.encode("latin-1"))
+            if key in dispatch:
+                dispatch[key] = _limited(opcode, dispatch[key])
+        _limited_dispatches[cls] = dispatch
+    return dispatch
+
+# The C implementation of the unpickler. It's missing on some interpreters (e.g. PyPy),
+# in which case pickle.Unpickler is simply the Python implementation.
+if PY2:
+    try:
+        import cPickle
+    except ImportError:
+        cPickle = None
+    HAS_C_UNPICKLER = cPickle is not None
+else:
+    HAS_C_UNPICKLER = pickle.Unpickler is not pickle._Unpickler
+
+if not HAS_C_UNPICKLER:
+    CSafeUnpickler = None
+
+elif PY2:
+    class CSafeUnpickler(object):
+        """
+        A variant of :class:`SafeUnpickler` which runs on the C implementation of the
+        unpickler, so the opcodes of the pickle stream aren't dispatched in python.
+        It takes the same arguments and substitutes classes in the same way.
+
+        The C implementation resolves extension codes using the :mod:`copyreg` registry by
+        itself, and caches what they resolve to for the whole process. So with *use_copyreg*
+        set to False, a stream that uses extension codes, or any stream while extensions are
+        registered, is unpickled by :class:`SafeUnpickler` instead, which gives the same
+        result. This requires *file* to be seekable when extensions are used.
+
+        As :class:`cPickle.Unpickler` cannot be subclassed, this wraps an instance of it
+        and installs :meth:`find_class` as its ``find_global`` hook.
+        """
+        def __init__(self, file, class_factory=None, safe_modules=(),
+                     use_copyreg=False, encoding="bytes", errors="strict"):
+            self.file = file
+            self.class_factory = class_factory or FakeClassFactory()
+            self.safe_modules = set(safe_modules)
+            self.use_copyreg = use_copyreg
+            self.encoding = encoding
+            self.errors = errors
+            self.unpickler = cPickle.Unpickler(file)
+            self.unpickler.find_global = self.find_class
+
+        find_class = SafeUnpickler.find_class.im_func
+
+        def load(self):
+            if self.use_copyreg:
+                return self.unpickler.load()
+            return _load_without_extensions(self, self.unpickler.load)
+
+else:
+    class CSafeUnpickler(pickle.Unpickler):
+        """
+        A variant of :class:`SafeUnpickler` which runs on the C implementation of the
+        unpickler, so the opcodes of the pickle stream aren't dispatched in python.
+        It takes the same arguments and substitutes classes in the same way.
+
+        The C implementation resolves extension codes using the :mod:`copyreg` registry by
+        itself, and caches what they resolve to for the whole process. So with *use_copyreg*
+        set to False, a stream that uses extension codes, or any stream while extensions are
+        registered, is unpickled by :class:`SafeUnpickler` instead, which gives the same
+        result. This requires *file* to be seekable when extensions are used.
+
+        It inherits from :class:`pickle.Unpickler`.
+        """
+        def __init__(self, file, class_factory=None, safe_modules=(),
+                     use_copyreg=False, encoding="bytes", errors="strict"):
+            super().__init__(file, fix_imports=False, encoding=encoding, errors=errors)
+            self.file = file
+            self.class_factory = class_factory or FakeClassFactory()
+            self.safe_modules = set(safe_modules)
+            self.use_copyreg = use_copyreg
+            self.encoding = encoding
+            self.errors = errors
+
+        find_class = SafeUnpickler.find_class
+
+        def load(self):
+            if self.use_copyreg:
+                return super().load()
+            return _load_without_extensions(self, super().load)
+
+def _load_without_extensions(unpickler, load):
+    # Runs load, the load method of the C unpickler, unless it would resolve extension
+    # codes through the copyreg registry. That can only happen while extensions are
+    # registered. Otherwise an extension code in the stream fails as unregistered, without
+    # anything being cached. Both cases are unpickled by SafeUnpickler instead.
+    if not copyreg._inverted_registry:
+        start = unpickler.file.tell()
+        try:
+            return load()
+        except ValueError as e:
+            if not str(e).startswith("unregistered extension code"):
+                raise
+        unpickler.file.seek(start)
+
+    return SafeUnpickler(unpickler.file, unpickler.class_factory, unpickler.safe_modules,
+                         encoding=unpickler.encoding, errors=unpickler.errors).load()
+
+# Profiling unpickler implementation
+
+class UnpicklingProfile(object):
+    """
+    Statistics about the unpickling of a pickle stream, gathered by :class:`ProfilingUnpickler`.
+
+    :attr:`opcodes` and :attr:`opcode_bytes` map opcode names to how often they occurred and
+    how many bytes they were read from, :attr:`instances` and :attr:`setstate_calls` map
+    ``"module.name"`` of classes to how many objects of them were created and how often
+    their ``__setstate__`` was called. :attr:`bytes` is the size of the stream,
+    :attr:`memo_size` the number of entries in the memo at the end, and :attr:`time` the
+    time spent unpickling in seconds.
+    """
+    def __init__(self):
+        self.opcodes = {}
+        self.opcode_bytes = {}
+        self.instances = {}
+        self.setstate_calls = {}
+        self.bytes = 0
+        self.memo_size = 0
+        self.time = 0.
+
+    def summary(self):
+        """
+        Returns the statistics as a human-readable table.
+        """
+        lines = ["%d bytes, %d opcodes, %d memo entries, %.2f ms" % (
+            self.bytes, sum(self.opcodes.values()), self.memo_size, self.time * 1000)]
+
+        lines.append("  %-40s %10s %10s" % ("opcode", "count", "bytes"))
+        for name, count in sorted(self.opcodes.items(), key=lambda i: (-i[1], i[0])):
+            lines.append("  %-40s %10d %10d" % (name, count, self.opcode_bytes[name]))
+
+        lines.append("  %-40s %10s %10s" % ("class", "instances", "setstate"))
+        for name, count in sorted(self.instances.items(), key=lambda i: (-i[1], i[0])):
+            lines.append("  %-40s %10d %10d" % (name, count, self.setstate_calls.get(name, 0)))
+        return "\n".join(lines)
+
+class _CountingFile(object):
+    # wraps a binary file object, counting the bytes read from it
+    def __init__(self, file):
+        self.file = file
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self):
+        data = self.file.readline()
+        self.count += len(data)
+        return data
+
+    def readinto(self, buf):
+        size = self.file.readinto(buf)
+        self.count += size
+        return size
+
+def _class_name(klass):
+    return "{0}.{1}".format(klass.__module__, klass.__name__)
+
+def _profiled(name, func):
+    # wraps the dispatch function of an opcode to count it
+    instantiates = name in ("INST", "OBJ", "NEWOBJ", "NEWOBJ_EX", "REDUCE")
+
+    def profiled(self):
+        profile = self.profile
+        start = self.counting_file.count
+        if name == "BUILD" and getattr(self.stack[-2], "__setstate__", None) is not None:
+            klass = _class_name(type(self.stack[-2]))
+            profile.setstate_calls[klass] = profile.setstate_calls.get(klass, 0) + 1
+        try:
+            func(self)
+        finally:
+            # STOP ends the unpickling by raising an exception
+            profile.opcodes[name] = profile.opcodes.get(name, 0) + 1
+            # the opcode itself was read before dispatching
+            size = self.counting_file.count - start + 1
+            profile.opcode_bytes[name] = profile.opcode_bytes.get(name, 0) + size
+        if instantiates:
+            klass = _class_name(type(self.stack[-1]))
+            profile.instances[klass] = profile.instances.get(klass, 0) + 1
+    return profiled
+
+class ProfilingUnpickler(SafeUnpickler):
+    """
+    A :class:`SafeUnpickler` which gathers statistics about the pickle stream while it's
+    unpickled: how often every opcode occurs, how many objects of each class are created
+    and how often their ``__setstate__`` is called. They're collected in :attr:`profile`,
+    an :class:`UnpicklingProfile` instance.
+
+    Counting costs time, so the time in the profile is only useful for comparisons with
+    other profiles. In framed streams (protocol 4 and up) the bytes of a whole frame are
+    counted for its ``FRAME`` opcode. The arguments are the same as those of :class:`SafeUnpickler`,
+    including the limits.
+    """
+    def __init__(self, file, class_factory=None, safe_modules=(),
+                 use_copyreg=False, encoding="bytes", errors="strict",
+                 max_objects=None, max_length=None, max_depth=None):
+        self.counting_file = _CountingFile(file)
+        SafeUnpickler.__init__(self, self.counting_file, class_factory, safe_modules,
+                               use_copyreg, encoding=encoding, errors=errors,
+                               max_objects=max_objects, max_length=max_length,
+                               max_depth=max_depth)
+        self.profile = UnpicklingProfile()
+
+    def load(self):
+        start = timeit.default_timer()
+        try:
+            return SafeUnpickler.load(self)
+        finally:
+            self.profile.time += timeit.default_timer() - start
+            self.profile.bytes = self.counting_file.count
+            self.profile.memo_size = len(self.memo)
+
+    dispatch = SafeUnpickler.dispatch.copy()
+    for opcode in pickletools.opcodes:
+        key = _opcode_key(opcode.code if PY2 else opcode.code.encode("latin-1"))
+        if key in dispatch:
+            dispatch[key] = _profiled(opcode.name, dispatch[key])
+    del opcode, key
 
 class SafePickler(pickle.Pickler if PY2 else pickle._Pickler):
     """
@@ -520,17 +1052,26 @@ class SafePickler(pickle.Pickler if PY2 else pickle._Pickler):
     the classes themselves, and we need to override the method used for normally saving classes.
     """
 
-    def save_global(self, obj, name=None, pack=struct.pack):
-        if isinstance(obj, FakeClassType):
-            self.write(pickle.GLOBAL + obj.__module__ + '\n' + obj.__name__ + '\n')
-            self.memoize(obj)
-            return
+    if PY2:
+        def save_global(self, obj, name=None, pack=struct.pack):
+            if isinstance(obj, FakeClassType):
+                self.write(pickle.GLOBAL + obj.__module__ + '\n' + obj.__name__ + '\n')
+                self.memoize(obj)
+                return
+
+            pickle.Pickler.save_global(self, obj, name, pack)
+    else:
+        def save_global(self, obj, name=None):
+            if isinstance(obj, FakeClassType):
+                self.write(pickle.GLOBAL + (obj.__module__ + '\n' + obj.__name__ + '\n').encode("utf-8"))
+                self.memoize(obj)
+                return
 
-        pickle.Pickler.save_global(self, obj, name, pack)
+            super().save_global(obj, name)
 
 # the main API
 
-def load(file, class_factory=None, encoding="bytes", errors="errors"):
+def load(file, class_factory=None, encoding="bytes", errors="strict"):
     """
     Read a pickled object representation from the open binary :term:`file object` *file*
     and return the reconstitutded object hierarchy specified therein, generating
@@ -551,7 +1092,7 @@ def load(file, class_factory=None, encoding="bytes", errors="errors"):
     """
     return FakeUnpickler(file, class_factory, encoding=encoding, errors=errors).load()
 
-def loads(string, class_factory=None, encoding="bytes", errors="errors"):
+def loads(string, class_factory=None, encoding="bytes", errors="strict"):
     """
     Simjilar to :func:`load`, but takes an 8-bit string (bytes in Python 3, str in Python 2)
     as its first argument instead of a binary :term:`file object`.
@@ -560,7 +1101,8 @@ def loads(string, class_factory=None, encoding="bytes", errors="errors"):
                          encoding=encoding, errors=errors).load()
 
 def safe_load(file, class_factory=None, safe_modules=(), use_copyreg=False,
-              encoding="bytes", errors="errors"):
+              encoding="bytes", errors="strict", accelerate=True,
+              max_objects=None, max_length=None, max_depth=None):
     """
     Read a pickled object representation from the open binary :term:`file object` *file*
     and return the reconstitutded object hierarchy specified therein, substituting any
@@ -583,20 +1125,47 @@ def safe_load(file, class_factory=None, safe_modules=(), use_copyreg=False,
     load them as bytes objects, otherwise it will attempt to decode them into unicode
     using the given *encoding* and *errors* arguments.
 
+    If *accelerate* is True and the C implementation of the unpickler is available,
+    :class:`CSafeUnpickler` is used instead of :class:`SafeUnpickler`.
+
+    *max_objects*, *max_length* and *max_depth* limit the resources the pickle can use, as
+    described at :class:`SafeUnpickler`. The C implementation can't check them, so if any of
+    them are set :class:`SafeUnpickler` is always used.
+
     This function can be used to unpickle untrusted data safely with the default
     class_factory when *safe_modules* is empty and *use_copyreg* is False.
     """
-    return SafeUnpickler(file, class_factory, safe_modules, use_copyreg,
-                         encoding=encoding, errors=errors).load()
+    if max_objects is not None or max_length is not None or max_depth is not None:
+        return SafeUnpickler(file, class_factory, safe_modules, use_copyreg,
+                             encoding=encoding, errors=errors, max_objects=max_objects,
+                             max_length=max_length, max_depth=max_depth).load()
+
+    unpickler = CSafeUnpickler if accelerate and HAS_C_UNPICKLER else SafeUnpickler
+    return unpickler(file, class_factory, safe_modules, use_copyreg,
+                     encoding=encoding, errors=errors).load()
 
 def safe_loads(string, class_factory=None, safe_modules=(), use_copyreg=False,
-               encoding="bytes", errors="errors"):
+               encoding="bytes", errors="strict", accelerate=True,
+               max_objects=None, max_length=None, max_depth=None):
     """
     Similar to :func:`safe_load`, but takes an 8-bit string (bytes in Python 3, str in Python 2)
     as its first argument instead of a binary :term:`file object`.
     """
-    return SafeUnpickler(StringIO(string), class_factory, safe_modules, use_copyreg,
-                         encoding=encoding, errors=errors).load()
+    return safe_load(StringIO(string), class_factory, safe_modules, use_copyreg,
+                     encoding=encoding, errors=errors, accelerate=accelerate,
+                     max_objects=max_objects, max_length=max_length, max_depth=max_depth)
+
+def profile_loads(string, class_factory=None, safe_modules=(), use_copyreg=False,
+                  encoding="bytes", errors="strict",
+                  max_objects=None, max_length=None, max_depth=None):
+    """
+    Similar to :func:`safe_loads`, but returns a tuple of the unpickled object and an
+    :class:`UnpicklingProfile` with statistics about the pickle, see :class:`ProfilingUnpickler`.
+    """
+    unpickler = ProfilingUnpickler(StringIO(string), class_factory, safe_modules, use_copyreg,
+                                   encoding=encoding, errors=errors, max_objects=max_objects,
+                                   max_length=max_length, max_depth=max_depth)
+    return unpickler.load(), unpickler.profile
 
 def safe_dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL):
     """
@@ -668,6 +1237,8 @@ def remove_fake_package(name):
 
     # Remove all module and submodule entries from sys.modules
     package._remove()
+    # and the references to them from cached subclass checks
+    _subclass_cache.clear()
 
     # It is impossible to kill references to the modules, but all traces
     # of it have been removed from the import machinery and the submodule
@@ -25,18 +25,21 @@ import ast
 from operator import itemgetter
 from contextlib import contextmanager
 
-from util import DecompilerBase, WordConcatenator, reconstruct_paraminfo, \
-                 simple_expression_guard, split_logical_lines, Dispatcher
-import codegen
+from .util import DecompilerBase, WordConcatenator, reconstruct_paraminfo, \
+                  simple_expression_guard, split_logical_lines, Dispatcher
+from . import codegen
+
+from renpy.ast import PyExpr
 
 # Main API
 
 def pprint(out_file, ast, indent_level=0, linenumber=1,
            decompile_python=False,
            skip_indent_until_write=False, printlock=None):
-    return SLDecompiler(out_file, printlock=printlock,
-                 decompile_python=decompile_python).dump(
-                     ast, indent_level, linenumber, skip_indent_until_write)
+    decompiler = SLDecompiler(out_file, printlock=printlock, decompile_python=decompile_python)
+    linenumber = decompiler.dump(ast, indent_level, linenumber, skip_indent_until_write)
+    decompiler.flush()
+    return linenumber
 
 # implementation
 
@@ -114,9 +117,9 @@ class SLDecompiler(DecompilerBase):
         keywords = {ast.code.location[1]: WordConcatenator(False, True)}
         for key in ('modal', 'zorder', 'variant', 'predict'):
             value = getattr(ast, key)
-            # Non-Unicode strings are default values rather than user-supplied
+            # Non-PyExpr strings are default values rather than user-supplied
             # values, so we don't need to write them out.
-            if isinstance(value, unicode):
+            if isinstance(value, PyExpr):
                 if value.linenumber not in keywords:
                     keywords[value.linenumber] = WordConcatenator(False, True)
                 keywords[value.linenumber].append("%s %s" % (key, value))
@@ -321,7 +324,8 @@ class SLDecompiler(DecompilerBase):
         if dispatch_key:
             func = self.dispatch.get(dispatch_key, self.print_python.__func__)
             if has_block:
-                if func not in (self.print_onechild.__func__,
+                # the handlers may be wrapped by util.profile_handlers
+                if getattr(func, '__wrapped__', func) not in (self.print_onechild.__func__,
                     self.print_manychildren.__func__):
                     raise BadHasBlockException()
                 func(self, header, code, True)
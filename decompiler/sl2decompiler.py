@@ -22,8 +22,8 @@ from __future__ import unicode_literals
 import sys
 from operator import itemgetter
 
-from util import DecompilerBase, First, reconstruct_paraminfo, \
-                 reconstruct_arginfo, split_logical_lines, Dispatcher
+from .util import DecompilerBase, First, reconstruct_paraminfo, \
+                  reconstruct_arginfo, split_logical_lines, Dispatcher
 
 from renpy import ui, sl2
 from renpy.ast import PyExpr
@@ -35,11 +35,16 @@ from renpy.display import layout, behavior, im, motion, dragdrop
 
 def pprint(out_file, ast, indent_level=0, linenumber=1,
            skip_indent_until_write=False, printlock=None):
-    return SL2Decompiler(out_file, printlock=printlock).dump(
-        ast, indent_level, linenumber, skip_indent_until_write)
+    decompiler = SL2Decompiler(out_file, printlock=printlock)
+    linenumber = decompiler.dump(ast, indent_level, linenumber, skip_indent_until_write)
+    decompiler.flush()
+    return linenumber
 
 # Implementation
 
+def location_linenumber(ast):
+    return ast.location[1]
+
 class SL2Decompiler(DecompilerBase):
     """
     An object which handles the decompilation of renpy screen language 2 screens to a given stream
@@ -48,10 +53,10 @@ class SL2Decompiler(DecompilerBase):
     # This dictionary is a mapping of Class: unbound_method, which is used to determine
     # what method to call for which slast class
     dispatch = Dispatcher()
+    print_plans = {}
 
-    def print_node(self, ast):
-        self.advance_to_line(ast.location[1])
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+    def make_print_plan(self, ast):
+        return location_linenumber, self.dispatch.get(type(ast), type(self).print_unknown)
 
     @dispatch(sl2.slast.SLScreen)
     def print_screen(self, ast):
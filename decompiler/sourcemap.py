@@ -0,0 +1,119 @@
+# Copyright (c) 2012 Yuri K. Schlesner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Source maps
+#
+# A source map links every line of a decompiled file to the AST node printed there: the last
+# node that started printing on or before that line. The decompiler collects the nodes as
+# (output line, node type, original line number, label) tuples, see DecompilerBase.map_node.
+#
+# Layout, see util.BinaryFile:
+#   header: number of output lines, offset of the lines table, number of nodes, offset of the
+#           nodes table, number of strings, offset of the strings table
+#   lines:  for every output line, starting at line 1, the index of its node or NO_NODE
+#   nodes:  entries of (output line, type string, original line number, label string or NO_NODE)
+#   strings: entries of (offset, length) of the UTF-8 type and label names that follow
+
+import struct
+
+from .util import binary_header, BinaryFile
+
+MAGIC = b"UNRPYMAP"
+NO_NODE = 0xFFFFFFFF
+_HEADER = binary_header(6)
+_LINE = struct.Struct("<I")
+_NODE = struct.Struct("<IIII")
+_STRING = struct.Struct("<II")
+
+def write_source_map(out_file, nodes, line_count):
+    """
+    Writes the `nodes` collected while decompiling a file of `line_count` lines as a source map.
+    """
+    strings = {}
+    def string(name):
+        if name not in strings:
+            strings[name] = len(strings)
+        return strings[name]
+
+    lines = [NO_NODE] * line_count
+    node_table = []
+    for index, (line, kind, linenumber, label) in enumerate(nodes):
+        if 0 < line <= line_count:
+            lines[line - 1] = index
+        node_table.append(_NODE.pack(line, string(kind), linenumber or 0,
+                                     NO_NODE if label is None else string(label)))
+    # lines on which no node starts belong to the one before them
+    for i in range(1, line_count):
+        if lines[i] == NO_NODE:
+            lines[i] = lines[i - 1]
+
+    names = [name.encode("utf-8") for name, index in sorted(strings.items(), key=lambda i: i[1])]
+    lines_offset = _HEADER.size
+    nodes_offset = lines_offset + line_count * _LINE.size
+    strings_offset = nodes_offset + len(node_table) * _NODE.size
+    offset = strings_offset + len(names) * _STRING.size
+
+    out_file.write(_HEADER.pack(MAGIC, line_count, lines_offset, len(node_table), nodes_offset,
+                                len(names), strings_offset))
+    out_file.write(struct.pack("<%dI" % line_count, *lines))
+    for entry in node_table:
+        out_file.write(entry)
+    for name in names:
+        out_file.write(_STRING.pack(offset, len(name)))
+        offset += len(name)
+    for name in names:
+        out_file.write(name)
+
+class SourceMap(BinaryFile):
+    """
+    A source map, see write_source_map.
+    """
+    MAGIC = MAGIC
+    NAME = "source map"
+    FIELDS = ("line_count", "lines_offset", "node_count", "nodes_offset", "string_count",
+              "strings_offset")
+    TABLES = (("lines_offset", "line_count", _LINE.size),
+              ("nodes_offset", "node_count", _NODE.size),
+              ("strings_offset", "string_count", _STRING.size))
+
+    def __len__(self):
+        return self.line_count
+
+    def _string(self, index):
+        offset, length = _STRING.unpack_from(self.contents, self.strings_offset + index * _STRING.size)
+        return self.contents[offset:offset + length].decode("utf-8")
+
+    def node(self, index):
+        """
+        Returns the (output line, node type, original line number, label) of the node at `index`.
+        """
+        if not 0 <= index < self.node_count:
+            raise IndexError(index)
+        line, kind, linenumber, label = _NODE.unpack_from(self.contents, self.nodes_offset + index * _NODE.size)
+        return line, self._string(kind), linenumber, None if label == NO_NODE else self._string(label)
+
+    def lookup(self, line):
+        """
+        Returns the node printed on output line `line` like node does, or None if there is none.
+        """
+        if not 0 < line <= self.line_count:
+            return None
+        index, = _LINE.unpack_from(self.contents, self.lines_offset + (line - 1) * _LINE.size)
+        return None if index == NO_NODE else self.node(index)
@@ -19,15 +19,18 @@
 # SOFTWARE.
 
 from __future__ import unicode_literals
-from util import DecompilerBase, split_logical_lines, Dispatcher, string_escape
+from operator import attrgetter
+from .util import DecompilerBase, split_logical_lines, Dispatcher, string_escape
 from renpy.test import testast
 
 # Main API
 
 def pprint(out_file, ast, indent_level=0, linenumber=1,
            skip_indent_until_write=False, printlock=None):
-    return TestcaseDecompiler(out_file, printlock=printlock).dump(
-        ast, indent_level, linenumber, skip_indent_until_write)
+    decompiler = TestcaseDecompiler(out_file, printlock=printlock)
+    linenumber = decompiler.dump(ast, indent_level, linenumber, skip_indent_until_write)
+    decompiler.flush()
+    return linenumber
 
 # Implementation
 
@@ -39,11 +42,11 @@ class TestcaseDecompiler(DecompilerBase):
     # This dictionary is a mapping of Class: unbound_method, which is used to determine
     # what method to call for which testast class
     dispatch = Dispatcher()
+    print_plans = {}
 
-    def print_node(self, ast):
-        if hasattr(ast, 'linenumber'):
-            self.advance_to_line(ast.linenumber)
-        self.dispatch.get(type(ast), type(self).print_unknown)(self, ast)
+    def make_print_plan(self, ast):
+        linenumber = attrgetter('linenumber') if hasattr(ast, 'linenumber') else None
+        return linenumber, self.dispatch.get(type(ast), type(self).print_unknown)
 
     @dispatch(testast.Python)
     def print_python(self, ast):
@@ -18,11 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from util import say_get_code
+from .util import say_get_code, binary_header, BinaryFile
 import renpy
 
 import hashlib
+import itertools
 import re
+import struct
 from copy import copy
 
 class Translator(object):
@@ -134,3 +136,117 @@ class Translator(object):
             group = [ ]
 
         children[:] = new_children
+
+# Indexed translation files
+#
+# Instead of one pickle of everything, these store every translated block as a separate pickle,
+# with tables of the identifiers and strings sorted so they can be binary searched. A reader
+# only has to unpickle the blocks it asks for, so opening one doesn't depend on its size.
+#
+# Layout, see util.BinaryFile:
+#   header: offset and length of the language, offset and number of entries of the
+#           dialogue table, offset and number of entries of the strings table
+#   tables: entries of (key offset, key length, value offset, value length), sorted by key
+#   data:   keys and strings as UTF-8, and dialogue blocks as pickles
+
+INDEXED_MAGIC = b"UNRPYCTL"
+_HEADER = binary_header(6)
+_ENTRY = struct.Struct("<IIII")
+
+def is_indexed_translations(contents):
+    return contents[:len(INDEXED_MAGIC)] == INDEXED_MAGIC
+
+def _encode(string):
+    return string if isinstance(string, bytes) else string.encode("utf-8")
+
+def write_indexed_translations(out_file, language, dialogue, strings, dumps):
+    """
+    Writes `language`, `dialogue` and `strings` as an indexed translation file. The blocks in
+    `dialogue` are serialized with `dumps`.
+    """
+    data = [_encode(language)]
+    size = _HEADER.size + (len(dialogue) + len(strings)) * _ENTRY.size
+    offset = size + len(data[0])
+    header = [INDEXED_MAGIC, size, len(data[0])]
+    tables = []
+
+    for mapping, encode_value in ((dialogue, dumps), (strings, _encode)):
+        header.extend((_HEADER.size + len(tables) * _ENTRY.size, len(mapping)))
+        entries = sorted(((_encode(key), value) for key, value in mapping.items()), key=lambda i: i[0])
+        for key, value in entries:
+            value = encode_value(value)
+            tables.append(_ENTRY.pack(offset, len(key), offset + len(key), len(value)))
+            data.extend((key, value))
+            offset += len(key) + len(value)
+
+    out_file.write(_HEADER.pack(*header))
+    for item in itertools.chain(tables, data):
+        out_file.write(item)
+
+class TranslationTable(object):
+    """
+    A read-only mapping over a table in an indexed translation file. Values are only read
+    (and decoded with `decode`) when they're looked up.
+    """
+    def __init__(self, contents, offset, count, decode):
+        self.contents = contents
+        self.offset = offset
+        self.count = count
+        self.decode = decode
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, key):
+        # binary search for the entry of key
+        key = _encode(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = _ENTRY.unpack_from(
+                self.contents, self.offset + middle * _ENTRY.size)
+            found = self.contents[key_offset:key_offset + key_length]
+            if found == key:
+                return value_offset, value_length
+            elif found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        entry = self._find(key)
+        if entry is None:
+            return default
+        value_offset, value_length = entry
+        return self.decode(self.contents[value_offset:value_offset + value_length])
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+class IndexedTranslations(BinaryFile):
+    """
+    An indexed translation file with the `language`, `dialogue` and `strings` a Translator
+    needs. Dialogue blocks are unpickled with `loads`.
+    """
+    MAGIC = INDEXED_MAGIC
+    NAME = "indexed translation file"
+    FIELDS = ("language_offset", "language_length", "dialogue_offset", "dialogue_count",
+              "strings_offset", "strings_count")
+    TABLES = (("language_offset", "language_length", 1),
+              ("dialogue_offset", "dialogue_count", _ENTRY.size),
+              ("strings_offset", "strings_count", _ENTRY.size))
+
+    def __init__(self, contents, loads):
+        BinaryFile.__init__(self, contents)
+        self.language = contents[self.language_offset:
+                                 self.language_offset + self.language_length].decode("utf-8")
+        self.dialogue = TranslationTable(contents, self.dialogue_offset, self.dialogue_count, loads)
+        self.strings = TranslationTable(contents, self.strings_offset, self.strings_count,
+                                        lambda value: value.decode("utf-8"))
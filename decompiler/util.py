@@ -1,13 +1,61 @@
 from __future__ import unicode_literals
 import sys
 import re
-from StringIO import StringIO
+import struct
+import types
 from contextlib import contextmanager
+from timeit import default_timer
+
+PY3 = sys.version_info >= (3, 0)
+
+if PY3:
+    unicode = str
+    xrange = range
+
+class OutputBuffer(object):
+    """
+    A minimal file-like object which collects everything written to it, so it can be joined
+    and written out in one go instead of piece by piece.
+    """
+    def __init__(self):
+        self.fragments = []
+        self.write = self.fragments.append
+
+    def getvalue(self):
+        return "".join(self.fragments)
+
+    def mark(self):
+        """
+        Return a position in the output which can later be passed to truncate or insert
+        """
+        return len(self.fragments)
+
+    def truncate(self, mark):
+        """
+        Throw away everything written since `mark`
+        """
+        del self.fragments[mark:]
+
+    def insert(self, mark, string):
+        """
+        Insert `string` at `mark`, in front of everything written since
+        """
+        self.fragments.insert(mark, string)
 
 class DecompilerBase(object):
     def __init__(self, out_file=None, indentation='    ', printlock=None):
-        self.out_file = out_file or sys.stdout
+        if isinstance(out_file, OutputBuffer):
+            # A nested decompiler, whoever created the buffer writes it out
+            self.output = None
+            self.out_file = out_file
+        else:
+            self.output = out_file or sys.stdout
+            self.out_file = OutputBuffer()
         self.indentation = indentation
+        self.indent_strings = {}
+        # a list to collect the nodes for a source map in, see map_node
+        self.source_map = None
+        self.source_map_label = None
         self.skip_indent_until_write = False
         self.printlock = printlock
 
@@ -29,6 +77,14 @@ class DecompilerBase(object):
         self.print_nodes(ast)
         return self.linenumber
 
+    def flush(self):
+        """
+        Write everything buffered so far to the file given in the constructor
+        """
+        if self.output is not None:
+            self.output.write(self.out_file.getvalue())
+            self.out_file = OutputBuffer()
+
     @contextmanager
     def increase_indent(self, amount=1):
         self.indent_level += amount
@@ -41,7 +97,8 @@ class DecompilerBase(object):
         """
         Shorthand method for writing `string` to the file
         """
-        string = unicode(string)
+        if type(string) is not unicode:
+            string = unicode(string)
         self.linenumber += string.count('\n')
         self.skip_indent_until_write = False
         self.out_file.write(string)
@@ -61,30 +118,28 @@ class DecompilerBase(object):
         """
         Save our current state.
         """
-        state = (self.out_file, self.skip_indent_until_write, self.linenumber,
+        return (self.out_file.mark(), self.skip_indent_until_write, self.linenumber,
             self.block_stack, self.index_stack, self.indent_level, self.blank_line_queue)
-        self.out_file = StringIO()
-        return state
 
     def commit_state(self, state):
         """
         Commit changes since a saved state.
         """
-        out_file = state[0]
-        out_file.write(self.out_file.getvalue())
-        self.out_file = out_file
+        pass
 
     def rollback_state(self, state):
         """
         Roll back to a saved state.
         """
-        (self.out_file, self.skip_indent_until_write, self.linenumber,
+        (mark, self.skip_indent_until_write, self.linenumber,
             self.block_stack, self.index_stack, self.indent_level, self.blank_line_queue) = state
+        self.out_file.truncate(mark)
 
     def advance_to_line(self, linenumber):
         # If there was anything that we wanted to do as soon as we found a blank line,
-        # try to do it now.
-        self.blank_line_queue = filter(lambda m: m(linenumber), self.blank_line_queue)
+        # and we're about to skip over one, try to do it now.
+        if self.blank_line_queue and linenumber - self.linenumber > 1:
+            self.blank_line_queue = [m for m in self.blank_line_queue if m(linenumber)]
         if self.linenumber < linenumber:
             # Stop one line short, since the call to indent() will advance the last line.
             # Note that if self.linenumber == linenumber - 1, this will write the empty string.
@@ -95,7 +150,8 @@ class DecompilerBase(object):
         """
         Do something the next time we find a blank line. m should be a method that takes one
         parameter (the line we're advancing to), and returns whether or not it needs to run
-        again.
+        again. It is only called when advancing to that line leaves at least one blank line,
+        and with None at the end of the file.
         """
         self.blank_line_queue.append(m)
 
@@ -106,22 +162,65 @@ class DecompilerBase(object):
         calls the write method
         """
         if not self.skip_indent_until_write:
-            self.write('\n' + self.indentation * self.indent_level)
+            string = self.indent_strings.get(self.indent_level)
+            if string is None:
+                string = self.indent_strings[self.indent_level] = '\n' + self.indentation * self.indent_level
+            self.linenumber += 1
+            self.out_file.write(string)
 
     def print_nodes(self, ast, extra_indent=0):
         # This node is a list of nodes
         # Print every node
+        self.traverse(self.walk_nodes(ast, extra_indent))
+
+    def walk_nodes(self, ast, extra_indent=0):
+        # The generator version of print_nodes, to be yielded by handlers (see traverse)
         with self.increase_indent(extra_indent):
             self.block_stack.append(ast)
             self.index_stack.append(0)
 
             for i, node in enumerate(ast):
                 self.index_stack[-1] = i
-                self.print_node(node)
+                task = self.walk_node(node)
+                if task is not None:
+                    yield task
 
             self.block_stack.pop()
             self.index_stack.pop()
 
+    def traverse(self, task):
+        """
+        Run `task`, a generator returned by a handler, or do nothing if it is None. Handlers
+        which print blocks of child nodes are generators: for every block they yield the
+        generator returned by walk_nodes (or by another such handler), and they are resumed
+        once it has been printed completely. The generators are kept on an explicit stack here
+        instead of calling each other, so deeply nested scripts don't run into the recursion
+        limit. Exceptions are thrown into the generator that yielded the failing one.
+        """
+        if task is None:
+            return
+        stack = [task]
+        error = None
+        while stack:
+            try:
+                if error is None:
+                    task = next(stack[-1])
+                else:
+                    exc_info, error = error, None
+                    # keep the traceback of where the error happened
+                    task = stack[-1].throw(exc_info[1]) if PY3 else stack[-1].throw(*exc_info)
+            except StopIteration:
+                stack.pop()
+                continue
+            except Exception:
+                stack.pop()
+                if not stack:
+                    raise
+                error = sys.exc_info()
+                continue
+            if task is not None:
+                stack.append(task)
+
     @property
     def block(self):
         return self.block_stack[-1]
@@ -155,6 +254,33 @@ class DecompilerBase(object):
         self.write_failure("Unknown AST node: %s" % str(type(ast)))
 
     def print_node(self, ast):
+        self.traverse(self.walk_node(ast))
+
+    def walk_node(self, ast):
+        # Prints ast, returning the generator of its handler if that is one (see traverse)
+        try:
+            linenumber, handler = self.print_plans[type(ast)]
+        except KeyError:
+            linenumber, handler = self.print_plans[type(ast)] = self.make_print_plan(ast)
+        if linenumber is not None:
+            self.advance_to_line(linenumber(ast))
+        if self.source_map is not None:
+            self.map_node(ast, linenumber)
+        return handler(self, ast)
+
+    def map_node(self, ast, linenumber):
+        # Records that ast gets printed from here on, which is on the next line unless
+        # indent() is being skipped, for the source map
+        line = self.linenumber if self.skip_indent_until_write else self.linenumber + 1
+        original = linenumber(ast) if linenumber is not None else getattr(ast, 'linenumber', None)
+        self.source_map.append((line, type(ast).__name__, original, self.source_map_label))
+
+    def make_print_plan(self, ast):
+        """
+        Work out how to print nodes of the same type as `ast`. Returns a function giving the line
+        to advance to before printing such a node (or None to not advance), and the method which
+        prints it. The result is cached per node type in the print_plans dict of the class.
+        """
         raise NotImplementedError()
 
 class First(object):
@@ -433,7 +559,7 @@ class WordConcatenator(object):
         self.reorderable = reorderable
 
     def append(self, *args):
-        self.words.extend(filter(None, args))
+        self.words.extend(i for i in args if i)
 
     def join(self):
         if not self.words:
@@ -444,7 +570,7 @@ class WordConcatenator(object):
                     self.words.append(self.words.pop(i))
                     break
         last_word = self.words[-1]
-        self.words = map(lambda x: x[:-1] if x[-1] == ' ' else x, self.words[:-1])
+        self.words = [x[:-1] if x[-1] == ' ' else x for x in self.words[:-1]]
         self.words.append(last_word)
         rv = (' ' if self.needs_space else '') + ' '.join(self.words)
         self.needs_space = rv[-1] != ' '
@@ -458,6 +584,126 @@ class Dispatcher(dict):
             return func
         return closure
 
+# Handler profiling
+
+class HandlerProfile(object):
+    """
+    Call counts and inclusive and exclusive time of the handlers in the dispatch tables wrapped
+    by :func:`profile_handlers`. :attr:`stats` maps ``(decompiler class, node type)`` to a list
+    of ``[calls, inclusive time, exclusive time]``, in seconds. Handlers which are generators
+    are timed until they're exhausted, and the inclusive time of a handler which ends up calling
+    itself is counted for every call.
+    """
+    def __init__(self):
+        self.stats = {}
+        # the time spent in the handlers called by each handler that is running
+        self.stack = []
+
+    def enter(self):
+        self.stack.append(0.)
+
+    def exit(self, key, start):
+        elapsed = default_timer() - start
+        children = self.stack.pop()
+        if self.stack:
+            self.stack[-1] += elapsed
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0., 0.]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - children
+
+    def take(self):
+        """
+        Returns :attr:`stats` and starts over with empty ones.
+        """
+        stats, self.stats = self.stats, {}
+        return stats
+
+    def update(self, stats):
+        """
+        Adds `stats`, as returned by :meth:`take` in another process, to these.
+        """
+        for key, (calls, inclusive, exclusive) in stats.items():
+            own = self.stats.get(key)
+            if own is None:
+                own = self.stats[key] = [0, 0., 0.]
+            own[0] += calls
+            own[1] += inclusive
+            own[2] += exclusive
+
+    def summary(self):
+        """
+        Returns the statistics as a human-readable table, the most expensive handlers first.
+        """
+        lines = ["  %-20s %-30s %10s %15s %15s" % ("decompiler", "node", "calls", "inclusive (ms)",
+                                                   "exclusive (ms)")]
+        for (table, name), (calls, inclusive, exclusive) in sorted(
+                self.stats.items(), key=lambda i: (-i[1][2], i[0])):
+            lines.append("  %-20s %-30s %10d %15.2f %15.2f" % (table, name, calls, inclusive * 1000,
+                                                               exclusive * 1000))
+        return "\n".join(lines)
+
+# The profile the handlers are timed in, once profile_handlers has been called
+handler_profile = None
+
+def profile_handlers(classes):
+    """
+    Wraps every handler in the dispatch tables of the decompiler `classes`, so they're timed in
+    the returned :class:`HandlerProfile`. Only has an effect the first time it's called.
+    """
+    global handler_profile
+    if handler_profile is None:
+        handler_profile = HandlerProfile()
+        for cls in classes:
+            for key, handler in list(cls.dispatch.items()):
+                if isinstance(key, tuple):
+                    name = ".".join(key)
+                else:
+                    name = getattr(key, "__name__", str(key))
+                cls.dispatch[key] = _profiled_handler(handler, (cls.__name__, name), handler_profile)
+            # the cached print plans still point to the unwrapped handlers
+            if "print_plans" in cls.__dict__:
+                cls.print_plans.clear()
+    return handler_profile
+
+def _profiled_handler(handler, key, profile):
+    def profiled(self, *args, **kwargs):
+        start = default_timer()
+        profile.enter()
+        try:
+            result = handler(self, *args, **kwargs)
+        except Exception:
+            profile.exit(key, start)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return _profiled_generator(result, key, start, profile)
+        profile.exit(key, start)
+        return result
+    profiled.__wrapped__ = handler
+    return profiled
+
+def _profiled_generator(generator, key, start, profile):
+    # Passes the tasks of a generator handler on to traverse, and stops its clock once it's done
+    try:
+        error = None
+        while True:
+            try:
+                if error is None:
+                    task = next(generator)
+                else:
+                    exc_info, error = error, None
+                    task = generator.throw(exc_info[1]) if PY3 else generator.throw(*exc_info)
+            except StopIteration:
+                return
+            try:
+                yield task
+            except Exception:
+                error = sys.exc_info()
+    finally:
+        profile.exit(key, start)
+
 # ren'py string handling
 def encode_say_string(s):
     """
@@ -500,3 +746,50 @@ def say_get_code(ast, inmenu=False):
         rv.append(reconstruct_arginfo(ast.arguments))
 
     return " ".join(rv)
+
+# Binary file formats
+#
+# unrpyc's own binary files (indexed translation files and source maps) start with an 8 byte
+# magic, followed by a header of little-endian 32-bit unsigned integers which locate the
+# tables and data in the rest of the file. They're read in place, so opening one doesn't
+# depend on its size.
+
+_binary_headers = {}
+
+def binary_header(field_count):
+    """
+    Returns the struct of a header with `field_count` integers after the magic.
+    """
+    header = _binary_headers.get(field_count)
+    if header is None:
+        header = _binary_headers[field_count] = struct.Struct(str("<8s%dI" % field_count))
+    return header
+
+class BinaryFile(object):
+    """
+    Base class of the readers of those files. `contents` is a byte string or memory map.
+
+    Subclasses set MAGIC, NAME (used in errors), FIELDS, the attribute names of the header
+    integers, and TABLES, tuples of (offset field, count field, entry size) which have to fit
+    in `contents`.
+    """
+    MAGIC = None
+    NAME = None
+    FIELDS = ()
+    TABLES = ()
+
+    def __init__(self, contents):
+        header = binary_header(len(self.FIELDS))
+        if len(contents) < header.size or contents[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError("Not a valid %s" % self.NAME)
+        for name, value in zip(self.FIELDS, header.unpack_from(contents, 0)[1:]):
+            setattr(self, name, value)
+        for offset, count, size in self.TABLES:
+            if getattr(self, offset) + getattr(self, count) * size > len(contents):
+                raise ValueError("The %s is truncated" % self.NAME)
+        self.contents = contents
+
+    def close(self):
+        # closes the memory map the file was read from, if there is one
+        if hasattr(self.contents, "close"):
+            self.contents.close()
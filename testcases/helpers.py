@@ -0,0 +1,42 @@
+# Helpers shared by the regression tests in this directory.
+# Run the tests with "python -m unittest discover testcases" from the root of the repository.
+
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import unrpyc
+import decompiler
+from decompiler import astdump, sourcemap
+
+TESTCASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "script.rpyc")
+
+def load_testcase(**options):
+    # the AST of the testcase, loaded by unrpyc.read_ast_from_file with the given options
+    with open(TESTCASE, 'rb') as in_file:
+        return unrpyc.read_ast_from_file(in_file, **options)
+
+def node(klass, **attributes):
+    # an instance of the fake class unrpyc creates for klass, e.g. "renpy.ast.Say"
+    module, name = klass.rsplit(".", 1)
+    obj = unrpyc.class_factory(name, module)()
+    for key, value in attributes.items():
+        setattr(obj, key, value)
+    return obj
+
+def decompile(stmts, **options):
+    # returns the output of decompiler.pprint with the given options, and its source map
+    # as it would be written to a .rpy.map file
+    out_file = io.StringIO()
+    nodes = []
+    line_count = decompiler.pprint(out_file, stmts, source_map=nodes, **options)
+    map_file = io.BytesIO()
+    sourcemap.write_source_map(map_file, nodes, line_count)
+    return out_file.getvalue(), map_file.getvalue()
+
+def dump(ast):
+    out_file = io.StringIO()
+    astdump.pprint(out_file, ast)
+    return out_file.getvalue()
@@ -0,0 +1,96 @@
+# Regression tests for the resource limits of loading rpyc files.
+
+import io
+import pickle
+import struct
+import unittest
+import zlib
+
+from helpers import TESTCASE, load_testcase
+import unrpyc
+from decompiler import magic
+
+# a legacy rpyc file (a bare zlib stream) of a pickled 16 MiB string
+BOMB = zlib.compress(pickle.dumps(u"\0" * (16 << 20), 2), 9)
+
+LIMITS = {"max_size": 1 << 20, "max_objects": 100000, "max_length": 100000, "max_depth": 100}
+
+class BombTest(unittest.TestCase):
+    def test_load(self):
+        with self.assertRaises(magic.UnpicklingLimitError):
+            unrpyc.read_ast_from_file(io.BytesIO(BOMB), limits=LIMITS)
+
+    def test_profiled_load(self):
+        with self.assertRaises(magic.UnpicklingLimitError):
+            unrpyc.profile_ast_from_file(io.BytesIO(BOMB), LIMITS)
+
+    def test_reader(self):
+        data = BOMB if magic.PY2 else memoryview(BOMB)
+        reader = unrpyc.ZlibReader(data, max_size=LIMITS["max_size"])
+        with self.assertRaises(magic.UnpicklingLimitError):
+            reader.read()
+
+    def test_translations(self):
+        with self.assertRaises(magic.UnpicklingLimitError):
+            unrpyc.load_translations(b"\0" * (2 << 20), LIMITS)
+
+class LimitTest(unittest.TestCase):
+    def test_within_limits(self):
+        ast = load_testcase(limits=LIMITS)
+        with open(TESTCASE, 'rb') as in_file:
+            profiled, profile = unrpyc.profile_ast_from_file(in_file, LIMITS)
+        self.assertEqual(len(ast), len(profiled))
+
+    def test_profiled_max_objects(self):
+        with open(TESTCASE, 'rb') as in_file:
+            with self.assertRaises(magic.UnpicklingLimitError):
+                unrpyc.profile_ast_from_file(in_file, {"max_objects": 100})
+
+    def test_max_objects_counts_created_objects(self):
+        # an empty list and three ints. Filling the list, memoizing it and None create nothing
+        data = pickle.dumps([1, 2, 3, None], 2)
+        self.assertEqual(magic.safe_loads(data, max_objects=4), [1, 2, 3, None])
+        with self.assertRaises(magic.UnpicklingLimitError):
+            magic.safe_loads(data, max_objects=3)
+
+    def test_max_length(self):
+        data = pickle.dumps(list(range(10)), 2)
+        self.assertEqual(magic.safe_loads(data, max_length=10), list(range(10)))
+        with self.assertRaises(magic.UnpicklingLimitError):
+            magic.safe_loads(data, max_length=9)
+
+    def test_max_depth(self):
+        data = pickle.dumps([[1, 2], [3, 4]], 2)
+        self.assertEqual(magic.safe_loads(data, max_depth=2), [[1, 2], [3, 4]])
+        with self.assertRaises(magic.UnpicklingLimitError):
+            magic.safe_loads(data, max_depth=1)
+
+    def test_max_depth_without_marks(self):
+        # a list nested 200000 deep, pushing the lists without a single MARK
+        data = b"\x80\x02" + b"]" * 200000 + b"a" * 199999 + b"."
+        with self.assertRaises(magic.UnpicklingLimitError):
+            magic.safe_loads(data, max_depth=10, max_length=10)
+
+    def test_max_depth_through_memo(self):
+        # the same, but every list is put in the next one from the memo, so the stack never
+        # holds more than two of them
+        data = [b"\x80\x02]r" + struct.pack("<I", 0) + b"0"]
+        for i in range(1, 200000):
+            data.append(b"]j" + struct.pack("<I", i - 1) + b"ar" + struct.pack("<I", i) + b"0")
+        data.append(b"j" + struct.pack("<I", 199999) + b".")
+        data = b"".join(data)
+        with self.assertRaises(magic.UnpicklingLimitError):
+            magic.safe_loads(data, max_depth=10, max_length=10)
+
+    def test_max_depth_of_shared_objects(self):
+        shared = [[1]]
+        data = pickle.dumps([shared, [shared, shared]], 2)
+        self.assertEqual(len(magic.safe_loads(data, max_depth=4)), 2)
+        with self.assertRaises(magic.UnpicklingLimitError):
+            magic.safe_loads(data, max_depth=3)
+        cycle = []
+        cycle.append(cycle)
+        self.assertEqual(len(magic.safe_loads(pickle.dumps(cycle, 2), max_depth=1)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
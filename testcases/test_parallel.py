@@ -0,0 +1,27 @@
+# Regression tests for decompiling the top-level blocks of a file in parallel.
+
+import argparse
+import os
+import unittest
+
+from helpers import TESTCASE, load_testcase, decompile
+import unrpyc
+
+class ParallelBlocksTest(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, "fork"), "processes can't be forked on this platform")
+    def test_same_as_serial(self):
+        for init_offset in (False, True):
+            serial = decompile(load_testcase(), init_offset=init_offset)
+            for processes in (2, 3, 8, 40):
+                self.assertEqual(decompile(load_testcase(), init_offset=init_offset,
+                                           processes=processes), serial)
+
+    def test_only_big_files_are_split(self):
+        args = argparse.Namespace(parallel_blocks=True, processes="4")
+        self.assertEqual(unrpyc.block_processes(args, os.path.getsize(TESTCASE)), 1)
+        self.assertEqual(unrpyc.block_processes(args, unrpyc.PARALLEL_BLOCKS_MIN_SIZE), 4)
+        args.parallel_blocks = False
+        self.assertEqual(unrpyc.block_processes(args, unrpyc.PARALLEL_BLOCKS_MIN_SIZE), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# Regression tests for source maps.
+
+import unittest
+
+import helpers
+from helpers import load_testcase, node
+from decompiler import sourcemap
+
+FILENAME = u"game/script.rpy"
+
+def decompile(stmts):
+    # returns the output lines and the source map of it
+    output, map_data = helpers.decompile(stmts)
+    return output.splitlines(), sourcemap.SourceMap(map_data)
+
+class SourceMapTest(unittest.TestCase):
+    def test_testcase(self):
+        lines, source_map = decompile(load_testcase())
+        self.assertGreaterEqual(len(source_map), len(lines))
+
+        for number, line in enumerate(lines, 1):
+            entry = source_map.lookup(number)
+            if entry is None:
+                continue
+            self.assertLessEqual(entry[0], number)
+            text = line.strip()
+            if text.startswith("label "):
+                name = text[len("label "):].split("(")[0].rstrip(":")
+                self.assertEqual(entry[1:], ("Label", number, name))
+            elif text == "menu:":
+                self.assertEqual(entry[1], "Menu")
+
+    def test_say_inside_menu(self):
+        # label start:
+        #     menu:
+        #         e "Which one?"
+        #         "This one":
+        #             pass
+        # Ren'Py gives the say statement the line of the menu and an unconditional choice the
+        # native string "True"
+        say = node("renpy.ast.Say", filename=FILENAME, linenumber=2, who=u"e", what=u"Which one?",
+                   with_=None, interact=False, attributes=None)
+        choice = node("renpy.ast.Pass", filename=FILENAME, linenumber=5)
+        menu = node("renpy.ast.Menu", filename=FILENAME, linenumber=2, set=None, with_=None,
+                    items=[(u"This one", "True", [choice])])
+        label = node("renpy.ast.Label", filename=FILENAME, linenumber=1, name=u"start",
+                     parameters=None, hide=False, block=[say, menu])
+
+        lines, source_map = decompile([label])
+        self.assertEqual([line.strip() for line in lines[:5]],
+                         [u"label start:", u"menu:", u'e "Which one?"', u'"This one":', u"pass"])
+        self.assertEqual(source_map.lookup(1)[1], "Label")
+        self.assertEqual(source_map.lookup(2)[1:], ("Menu", 2, u"start"))
+        self.assertEqual(source_map.lookup(3)[1:], ("Say", 2, u"start"))
+        self.assertEqual(source_map.lookup(5)[1:], ("Pass", 5, u"start"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+# Regression tests for streaming the top-level statements of a file out of the decompiler.
+
+import unittest
+
+from helpers import load_testcase, decompile
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.stmts = load_testcase()
+
+    def test_same_as_regular_dump(self):
+        for init_offset in (False, True):
+            self.assertEqual(decompile(list(self.stmts), init_offset=init_offset, stream=True),
+                             decompile(self.stmts, init_offset=init_offset))
+
+    def test_frees_printed_statements(self):
+        stmts = list(self.stmts)
+        decompile(stmts, stream=True)
+        self.assertEqual(len(stmts), len(self.stmts))
+        self.assertEqual(stmts[:-2], [None] * (len(stmts) - 2))
+        self.assertEqual(stmts[-2:], self.stmts[-2:])
+
+    def test_regular_dump_keeps_statements(self):
+        stmts = list(self.stmts)
+        decompile(stmts)
+        self.assertEqual(stmts, self.stmts)
+
+if __name__ == '__main__':
+    unittest.main()
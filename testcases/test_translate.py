@@ -0,0 +1,41 @@
+# Regression tests for indexed translation files.
+
+import io
+import unittest
+
+# for the path to the decompiler
+import helpers
+from decompiler import magic, translate
+
+DIALOGUE = {u"start_1a2b3c4d": [u"first block"], u"start_5e6f7a8b": [u"second", u"block"]}
+STRINGS = {u"Start": u"Beginnen", u"Quit": u"Beenden"}
+
+def write():
+    out_file = io.BytesIO()
+    translate.write_indexed_translations(out_file, u"german", DIALOGUE, STRINGS,
+                                         lambda block: magic.safe_dumps(block, 2))
+    return out_file.getvalue()
+
+class IndexedTranslationsTest(unittest.TestCase):
+    def test_roundtrip(self):
+        contents = write()
+        self.assertTrue(translate.is_indexed_translations(contents))
+        translations = translate.IndexedTranslations(contents, magic.safe_loads)
+        self.assertEqual(translations.language, u"german")
+        self.assertEqual(len(translations.dialogue), 2)
+        for key, value in DIALOGUE.items():
+            self.assertEqual(translations.dialogue[key], value)
+        for key, value in STRINGS.items():
+            self.assertEqual(translations.strings.get(key), value)
+        self.assertNotIn(u"missing", translations.dialogue)
+        self.assertIsNone(translations.strings.get(u"missing"))
+
+    def test_invalid(self):
+        contents = write()
+        with self.assertRaises(ValueError):
+            translate.IndexedTranslations(b"UNRPYMAP" + contents[8:], magic.safe_loads)
+        with self.assertRaises(ValueError):
+            translate.IndexedTranslations(contents[:40], magic.safe_loads)
+
+if __name__ == '__main__':
+    unittest.main()
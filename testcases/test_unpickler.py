@@ -0,0 +1,99 @@
+# Regression tests comparing the C and the python safe unpickler.
+
+import sys
+import unittest
+import zlib
+
+from helpers import TESTCASE, load_testcase, dump
+import unrpyc
+from decompiler import magic
+
+if magic.PY3:
+    import copyreg
+else:
+    import copy_reg as copyreg
+
+# protocol 2 pickles of a tuple holding what the extension code 201 (EXT1) or
+# 0x1234 (EXT2) resolves to, and a string
+EXT1 = b"\x80\x02\x82\xc9X\x01\x00\x00\x00a\x86q\x00."
+EXT2 = b"\x80\x02\x83\x34\x12X\x01\x00\x00\x00a\x86q\x00."
+
+def load(data, accelerate, use_copyreg=False):
+    # through unrpyc.ZlibReader, which the C unpickler has to seek back in to restart
+    compressed = zlib.compress(data)
+    reader = unrpyc.ZlibReader(compressed if magic.PY2 else memoryview(compressed))
+    return magic.safe_load(reader, unrpyc.class_factory, {"_ast", "collections"},
+                           use_copyreg, encoding="utf-8", errors="surrogateescape",
+                           accelerate=accelerate)
+
+def describe(result):
+    klass, string = result
+    return klass.__module__, klass.__name__, string
+
+@unittest.skipUnless(magic.HAS_C_UNPICKLER, "no C unpickler on this interpreter")
+class CUnpicklerTest(unittest.TestCase):
+    def test_testcase(self):
+        with open(TESTCASE, 'rb') as in_file:
+            contents = in_file.read()
+        start, length = unrpyc.find_slot(contents, 1)
+        data = zlib.decompress(contents[start:start + length])
+        self.assertEqual(dump(load(data, True)), dump(load(data, False)))
+
+    def test_unregistered_extension(self):
+        for data in (EXT1, EXT2):
+            self.assertEqual(describe(load(data, True)), ("copyreg", "extension_code_%d" % (
+                201 if data is EXT1 else 0x1234), u"a"))
+            self.assertEqual(describe(load(data, True)), describe(load(data, False)))
+
+    def test_registered_extension(self):
+        copyreg.add_extension("os", "system", 201)
+        try:
+            c_result = describe(load(EXT1, True))
+            self.assertEqual(c_result, describe(load(EXT1, False)))
+            self.assertEqual(c_result, ("copyreg", "extension_code_201", u"a"))
+            # nothing may end up in the process-wide cache of the C unpickler
+            self.assertNotIn(201, copyreg._extension_cache)
+        finally:
+            copyreg.remove_extension("os", "system", 201)
+
+    def test_use_copyreg(self):
+        copyreg.add_extension("os", "system", 201)
+        try:
+            c_result = describe(load(EXT1, True, True))
+            self.assertEqual(c_result, describe(load(EXT1, False, True)))
+            # os isn't a safe module, so it's still a fake class
+            self.assertEqual(c_result, ("os", "system", u"a"))
+        finally:
+            copyreg.remove_extension("os", "system", 201)
+
+class InternerTest(unittest.TestCase):
+    def test_per_load(self):
+        plain = load_testcase()
+        string_interner = magic.Interner()
+        interned = load_testcase(string_interner=string_interner)
+
+        self.assertEqual(dump(interned), dump(plain))
+        self.assertTrue(string_interner.hits)
+        # nothing is kept for the next load
+        self.assertIsNone(unrpyc.interner)
+
+    def test_without_sizes(self):
+        # like on PyPy, where sys.getsizeof always raises a TypeError
+        def getsizeof(value):
+            raise TypeError("getsizeof(...) not implemented on this interpreter")
+        original = sys.getsizeof
+        sys.getsizeof = getsizeof
+        try:
+            string_interner = magic.Interner()
+            # built at runtime, so they aren't the same constant
+            first, second = u"".join([u"a", u"b"]), u"".join([u"a", u"b"])
+            self.assertIs(string_interner(second), string_interner(first))
+        finally:
+            sys.getsizeof = original
+        self.assertEqual(string_interner.hits, 1)
+        self.assertIsNone(string_interner.saved)
+        self.assertEqual(unrpyc.interner_summary(string_interner),
+                         "Interned 1 duplicate strings and locations")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import re
 import zlib
 import argparse
 import os, sys
@@ -55,6 +56,10 @@ except ImportError:
 def Module(name, filename, munge_globals=True):
     with open(filename, "rb" if p.PY2 else "r") as f:
         code = f.read()
+    # The modules are packed as top-level modules instead of as a package, so
+    # package-relative imports have to be turned into absolute ones
+    code = re.sub(r"^(\s*)from \. import ", r"\1import ", code, flags=re.M)
+    code = re.sub(r"^(\s*)from \.(\w+) import ", r"\1from \2 import ", code, flags=re.M)
     if args.minimize:
         # in modules only locals are worth optimizing
         code = minimize.minimize(code, True, args.obfuscate and munge_globals, args.obfuscate, args.obfuscate)
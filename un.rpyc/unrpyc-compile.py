@@ -120,7 +120,7 @@ def decompile_game():
         for abspath, fn, dir, data in sys.files:
             try:
                 decompile_rpyc(data, abspath, sys.init_offset)
-            except Exception, e:
+            except Exception as e:
                 f.write("\nFailed at decompiling {0}\n".format(abspath))
                 traceback = sys.modules['traceback']
                 traceback.print_exc(None, f)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python
 
 # Copyright (c) 2012 Yuri K. Schlesner
 #
@@ -27,11 +27,39 @@ import glob
 import itertools
 import traceback
 import struct
+import zlib
+import mmap
 from multiprocessing import Pool, Lock, cpu_count
 from operator import itemgetter
 
 import decompiler
-from decompiler import magic, astdump, translate
+from decompiler import magic, astdump, translate, sourcemap, util
+from decompiler import screendecompiler, sl2decompiler, testcasedecompiler
+
+if magic.PY3:
+    unicode = str
+
+# With --intern-strings, repeated strings and tuples like (filename, line) in the AST are
+# shared through a magic.Interner while unpickling. The unpickled classes can only reach it
+# through this global, which load_ast sets while it loads a file, so every load has its own.
+interner = None
+
+# attributes holding (filename, line) tuples, other tuples are rarely shared
+interned_tuples = frozenset(("loc", "location", "imspec"))
+
+class InternedStrict(magic.FakeStrict):
+    # The default fake class, which interns its text and location attributes
+    __slots__ = ()
+
+    def __setstate__(self, state):
+        # the state is either a dict, or a tuple of a dict and a dict of slots
+        if interner is not None:
+            for attributes in (state if isinstance(state, tuple) else (state,)):
+                if isinstance(attributes, dict):
+                    for key, value in attributes.items():
+                        if type(value) is unicode or key in interned_tuples:
+                            attributes[key] = interner(value)
+        magic.FakeStrict.__setstate__(self, state)
 
 # special definitions for special classes
 
@@ -39,7 +67,7 @@ class PyExpr(magic.FakeStrict, unicode):
     __module__ = "renpy.ast"
     def __new__(cls, s, filename, linenumber):
         self = unicode.__new__(cls, s)
-        self.filename = filename
+        self.filename = filename if interner is None else interner(filename)
         self.linenumber = linenumber
         return self
 
@@ -49,9 +77,13 @@ class PyExpr(magic.FakeStrict, unicode):
 class PyCode(magic.FakeStrict):
     __module__ = "renpy.ast"
     def __setstate__(self, state):
-        (_, self.source, self.location, self.mode) = state
+        (_, self.source, location, self.mode) = state
+        self.location = location if interner is None else interner(location)
         self.bytecode = None
 
+    def __getstate__(self):
+        return (1, self.source, self.location, self.mode)
+
 class RevertableList(magic.FakeStrict, list):
     __module__ = "renpy.python"
     def __new__(cls):
@@ -80,35 +112,410 @@ class Sentinel(magic.FakeStrict, object):
         obj.name = name
         return obj
 
-class_factory = magic.FakeClassFactory((PyExpr, PyCode, RevertableList, RevertableDict, RevertableSet, Sentinel), magic.FakeStrict)
+    def __getnewargs__(self):
+        return (self.name,)
+
+# Attribute layouts of the Ren'Py AST classes, which are used to give their fake classes
+# __slots__ instead of an instance dict. Attributes missing from here still work, they
+# just end up in a dict, so this doesn't have to match every Ren'Py version exactly.
+
+node_attributes = ("name", "filename", "linenumber", "next", "statement_start")
+sl_node_attributes = ("serial", "location")
+atl_attributes = ("loc",)
+
+ast_slots = dict(
+    [(("renpy.ast", name), node_attributes + attributes) for name, attributes in (
+        ("Say", ("who", "who_fast", "what", "with_", "interact", "attributes", "arguments",
+                 "temporary_attributes", "identifier", "explicit_identifier", "rollback")),
+        ("Init", ("block", "priority")),
+        ("Label", ("block", "parameters", "hide", "translation_relevant")),
+        ("Python", ("hide", "code", "store")),
+        ("EarlyPython", ("hide", "code", "store")),
+        ("Image", ("imgname", "code", "atl")),
+        ("Transform", ("varname", "atl", "parameters", "store")),
+        ("Show", ("imspec", "atl")),
+        ("ShowLayer", ("layer", "at_list", "atl")),
+        ("Scene", ("imspec", "layer", "atl")),
+        ("Hide", ("imspec",)),
+        ("With", ("expr", "paired")),
+        ("Call", ("label", "arguments", "expression")),
+        ("Return", ("expression",)),
+        ("Menu", ("items", "set", "with_", "has_caption", "arguments", "item_arguments",
+                  "rollback")),
+        ("Jump", ("target", "expression")),
+        ("Pass", ()),
+        ("While", ("condition", "block")),
+        ("If", ("entries",)),
+        ("UserStatement", ("line", "parsed", "block", "translatable", "code_block",
+                           "translation_relevant", "rollback", "subparses")),
+        ("Define", ("varname", "code", "store", "operator", "index")),
+        ("Default", ("varname", "code", "store")),
+        ("Screen", ("screen",)),
+        ("Translate", ("identifier", "language", "block", "alternate")),
+        ("EndTranslate", ()),
+        ("TranslateString", ("language", "old", "new", "newloc")),
+        ("TranslatePython", ("language", "code")),
+        ("TranslateBlock", ("block", "language")),
+        ("TranslateEarlyBlock", ("block", "language")),
+        ("Style", ("style_name", "parent", "properties", "clear", "take", "delattr",
+                   "variant")),
+    )] +
+    [(("renpy.sl2.slast", name), sl_node_attributes + attributes) for name, attributes in (
+        ("SLBlock", ("keyword", "children", "atl_transform")),
+        ("SLDisplayable", ("keyword", "children", "atl_transform", "displayable", "scope",
+                           "child_or_fixed", "style", "text_style", "pass_context",
+                           "imagemap", "positional", "hotspot", "replaces",
+                           "default_keywords", "variable", "name", "unique")),
+        ("SLIf", ("entries",)),
+        ("SLShowIf", ("entries",)),
+        ("SLFor", ("keyword", "children", "atl_transform", "variable", "expression",
+                   "index_expression")),
+        ("SLPython", ("code",)),
+        ("SLPass", ()),
+        ("SLDefault", ("variable", "expression")),
+        ("SLUse", ("target", "args", "id", "block")),
+        ("SLTransclude", ()),
+    )] +
+    [(("renpy.atl", name), atl_attributes + attributes) for name, attributes in (
+        ("RawBlock", ("statements", "animation")),
+        ("RawMultipurpose", ("warper", "duration", "properties", "expressions", "splines",
+                             "revolution", "circles", "warp_function")),
+        ("RawContainsExpr", ("expression",)),
+        ("RawChild", ("children",)),
+        ("RawParallel", ("blocks",)),
+        ("RawChoice", ("choices",)),
+        ("RawOn", ("handlers",)),
+        ("RawTime", ("time",)),
+        ("RawFunction", ("expr",)),
+        ("RawEvent", ("name",)),
+        ("RawRepeat", ("repeats",)),
+    )])
+
+def make_setstate(attributes):
+    """
+    Generates a __setstate__ for a node class which has the given attributes. It does what
+    InternedStrict.__setstate__ does, but if the state is a dict of only those attributes
+    (possibly in a (None, dict) tuple, as pickled by classes with __slots__), it assigns them
+    one by one without any generic checks. Any other state goes through InternedStrict.
+    """
+    lines = ["def make(known, missing, fallback):",
+             "  def __setstate__(self, state):",
+             "    slots = state",
+             "    if slots.__class__ is tuple and len(slots) == 2 and slots[0] is None:",
+             "        slots = slots[1]",
+             "    if slots.__class__ is dict and known.issuperset(slots):",
+             "        get = slots.get",
+             "        if interner is None:"]
+    for attribute in attributes:
+        lines.append("            value = get(%r, missing)" % attribute)
+        lines.append("            if value is not missing:")
+        lines.append("                self.%s = value" % attribute)
+    lines.append("            return")
+    for attribute in attributes:
+        lines.append("        value = get(%r, missing)" % attribute)
+        lines.append("        if value is not missing:")
+        if attribute in interned_tuples:
+            lines.append("            value = interner(value)")
+        else:
+            lines.append("            if value.__class__ is unicode:")
+            lines.append("                value = interner(value)")
+        lines.append("            self.%s = value" % attribute)
+    lines.append("        return")
+    lines.append("    fallback(self, state)")
+    lines.append("  return __setstate__")
+
+    # the function runs in the globals of this module, so it sees the current interner
+    namespace = {}
+    exec("\n".join(lines), globals(), namespace)
+    return namespace["make"](frozenset(attributes), object(), InternedStrict.__setstate__)
+
+ast_setstates = dict((key, make_setstate(attributes)) for key, attributes in ast_slots.items())
+
+class_factory = magic.FakeClassFactory((PyExpr, PyCode, RevertableList, RevertableDict, RevertableSet, Sentinel), InternedStrict, ast_slots, ast_setstates)
 
 printlock = Lock()
 
+# With --parallel-blocks, files at least this big (compressed) are split into blocks decompiled
+# by all processes. Forking a pool costs more than that saves on smaller files, so they're
+# decompiled in parallel with each other instead.
+PARALLEL_BLOCKS_MIN_SIZE = 256 << 10
+
 # API
 
-def read_ast_from_file(in_file):
-    # .rpyc files are just zlib compressed pickles of a tuple of some data and the actual AST of the file
-    raw_contents = in_file.read()
-    if raw_contents.startswith("RENPY RPC2"):
-        # parse the archive structure
-        position = 10
-        chunks = {}
-        while True:
-            slot, start, length = struct.unpack("III", raw_contents[position: position + 12])
-            if slot == 0:
+def map_file(in_file):
+    """
+    Returns the contents of `in_file` as a read-only memory map, or as a byte string
+    if it can't be mapped (it's not a real file, or it's empty).
+    """
+    try:
+        return mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        return in_file.read()
+
+def find_slot(contents, slot):
+    """
+    Returns the (start, length) of the compressed data in `slot` of an rpyc file, without
+    copying anything out of `contents`. Files from before the RPC2 format consist of only
+    a single compressed pickle, which is treated as slot 1.
+    """
+    size = len(contents)
+    if contents[:10] != b"RENPY RPC2":
+        if slot != 1:
+            raise ValueError("Legacy rpyc files only have slot 1")
+        return 0, size
+
+    # parse the archive structure
+    position = 10
+    chunks = {}
+    while True:
+        if position + 12 > size:
+            raise ValueError("Chunk table of the rpyc file is truncated")
+        chunk_slot, start, length = struct.unpack_from("III", contents, position)
+        if chunk_slot == 0:
+            break
+        position += 12
+
+        if start + length > size:
+            raise ValueError("Slot %d of the rpyc file points outside of the file" % chunk_slot)
+        chunks[chunk_slot] = start, length
+
+    if slot not in chunks:
+        raise ValueError("The rpyc file has no slot %d" % slot)
+    return chunks[slot]
+
+class ZlibReader(object):
+    """
+    A read-only binary file object which decompresses the zlib stream in `data` as it is
+    read, so the decompressed data never has to be held in memory all at once.
+    `data` has to be a memoryview on Python 3, and a str or buffer on Python 2.
+
+    If `max_size` is given, reading more than that many decompressed bytes raises a
+    magic.UnpicklingLimitError. The output of every step is limited to `chunk_size` bytes
+    then, so highly compressed input can't be inflated much beyond the limit.
+    """
+
+    def __init__(self, data, chunk_size=1 << 16, max_size=None):
+        self.data = data
+        self.offset = 0
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+        self.position = 0
+        self.max_size = max_size
+        self.size = 0
+        # zlib takes 0 as no limit on the output
+        self.max_output = 0 if max_size is None else chunk_size
+
+    def _fill(self):
+        # Decompresses the next chunk of input and appends it to the unread part of the
+        # buffer. Returns False when there is no input left.
+        if self.decompressor is None:
+            return False
+
+        if self.decompressor.unconsumed_tail:
+            # input left over from a step which hit max_output
+            output = self.decompressor.decompress(self.decompressor.unconsumed_tail, self.max_output)
+        elif self.offset < len(self.data):
+            end = self.offset + self.chunk_size
+            if magic.PY2:
+                output = self.decompressor.decompress(self.data[self.offset:end], self.max_output)
+            else:
+                # release the slice immediately, so the memory map behind it can be closed
+                with self.data[self.offset:end] as chunk:
+                    output = self.decompressor.decompress(chunk, self.max_output)
+            self.offset = end
+        elif self.max_output:
+            # flush can't limit its output, so whatever zlib still holds back is taken in steps
+            output = self.decompressor.decompress(b"", self.max_output)
+            if not output:
+                self.decompressor = None
+        else:
+            output = self.decompressor.flush()
+            self.decompressor = None
+
+        self.size += len(output)
+        if self.max_size is not None and self.size > self.max_size:
+            raise magic.UnpicklingLimitError(
+                "Decompressed data is larger than the limit of %d bytes" % self.max_size)
+
+        self.buffer = self.buffer[self.position:] + output
+        self.position = 0
+        return True
+
+    def read(self, size=-1):
+        if 0 <= size <= len(self.buffer) - self.position:
+            data = self.buffer[self.position:self.position + size]
+            self.position += size
+            return data
+
+        # collect the chunks separately, so big reads don't copy the buffer for every chunk
+        chunks = [self.buffer[self.position:]]
+        length = len(chunks[0])
+        self.buffer = b""
+        self.position = 0
+        while (size < 0 or length < size) and self._fill():
+            chunks.append(self.buffer)
+            length += len(self.buffer)
+            self.buffer = b""
+        data = b"".join(chunks)
+        if 0 <= size < len(data):
+            self.buffer = data[size:]
+            data = data[:size]
+        return data
+
+    def peek(self, size=1):
+        # The C unpickler uses this to prefetch data instead of calling read for every opcode
+        while len(self.buffer) - self.position < size and self._fill():
+            pass
+        return self.buffer[self.position:self.position + size]
+
+    def readline(self):
+        end = self.buffer.find(b"\n", self.position)
+        while end < 0:
+            searched = len(self.buffer) - self.position
+            if not self._fill():
+                end = len(self.buffer) - 1
                 break
-            position += 12
-
-            chunks[slot] = raw_contents[start: start + length]
-
-        raw_contents = chunks[1]
+            end = self.buffer.find(b"\n", searched)
+        data = self.buffer[self.position:end + 1]
+        self.position += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self.size - len(self.buffer) + self.position
+
+    def seek(self, position):
+        # Seeking backwards decompresses everything again from the start. It's only needed
+        # when magic.CSafeUnpickler has to restart with the python unpickler.
+        if position < self.tell():
+            self.offset = 0
+            self.decompressor = zlib.decompressobj()
+            self.buffer = b""
+            self.position = 0
+            self.size = 0
+        self.read(position - self.tell())
+        return position
+
+def read_ast_from_file(in_file, limits=None, string_interner=None):
+    # .rpyc files are just zlib compressed pickles of a tuple of some data and the actual AST of the file
+    # limits is a dict which can contain max_size, the maximum size of the decompressed pickle,
+    # and the max_objects, max_length and max_depth arguments of magic.SafeUnpickler.
+    # If a magic.Interner is passed as string_interner, repeated strings and locations in
+    # the AST are shared through it.
+    contents = map_file(in_file)
+    try:
+        return read_ast_from_contents(contents, limits, string_interner)
+    finally:
+        if isinstance(contents, mmap.mmap):
+            contents.close()
+
+def read_ast_from_contents(contents, limits=None, string_interner=None):
+    start, length = find_slot(contents, 1)
+    if magic.PY2:
+        return load_ast(buffer(contents, start, length), limits, string_interner)
+
+    # Release the views explicitly, since a memory map can't be closed while they're alive
+    with memoryview(contents) as view:
+        with view[start:start + length] as chunk:
+            return load_ast(chunk, limits, string_interner)
+
+def profile_ast_from_file(in_file, limits=None, string_interner=None):
+    """
+    Like read_ast_from_file, but returns a tuple of the AST and a magic.UnpicklingProfile
+    with statistics about unpickling it.
+    """
+    max_size, limits = split_limits(limits)
+    contents = map_file(in_file)
+    try:
+        start, length = find_slot(contents, 1)
+        raw_contents = decompress(contents[start:start + length], max_size)
+    finally:
+        if isinstance(contents, mmap.mmap):
+            contents.close()
+
+    global interner
+    interner = string_interner
+    try:
+        (data, stmts), profile = magic.profile_loads(raw_contents, class_factory, {"_ast", "collections"},
+                                                     encoding="utf-8", errors="surrogateescape",
+                                                     **limits)
+    finally:
+        interner = None
+    return stmts, profile
+
+def split_limits(limits):
+    # Returns the max_size of a dict of limits, and a dict of the limits for the unpickler
+    limits = dict(limits or {})
+    return limits.pop("max_size", None), limits
+
+def decompress(compressed, max_size=None):
+    # zlib.decompress, but never inflating more than max_size bytes
+    if max_size is None:
+        return zlib.decompress(compressed)
+
+    decompressor = zlib.decompressobj()
+    output = decompressor.decompress(compressed, max_size + 1)
+    if len(output) <= max_size and not decompressor.unconsumed_tail:
+        # instead of flush, which can't limit its output
+        output += decompressor.decompress(b"", max_size + 1 - len(output))
+    if len(output) > max_size or decompressor.unconsumed_tail:
+        raise magic.UnpicklingLimitError(
+            "Decompressed data is larger than the limit of %d bytes" % max_size)
+    return output
+
+def load_ast(compressed, limits=None, string_interner=None):
+    global interner
+    max_size, limits = split_limits(limits)
+
+    interner = string_interner
+    try:
+        if magic.PY2:
+            # cPickle only reads quickly from real files and cStringIO objects, and calls read
+            # for every opcode otherwise. So on Python 2 the pickle is decompressed first.
+            data, stmts = magic.safe_loads(decompress(compressed, max_size), class_factory,
+                                           {"_ast", "collections"}, **limits)
+            return stmts
+
+        # The pickle is unpickled while it's being decompressed. Python 2 str objects in it get
+        # decoded the same way Ren'Py does when it loads Python 2 pickles on Python 3.
+        data, stmts = magic.safe_load(ZlibReader(compressed, max_size=max_size), class_factory,
+                                      {"_ast", "collections"}, encoding="utf-8",
+                                      errors="surrogateescape", **limits)
+        return stmts
+    finally:
+        interner = None
+
+def read_ast(input_filename, profile=False, limits=None, intern_strings=False):
+    # Loads the AST of an rpyc file, printing a summary of the unpickling if profile is set
+    string_interner = magic.Interner() if intern_strings else None
+    with open(input_filename, 'rb') as in_file:
+        if not profile:
+            return read_ast_from_file(in_file, limits=limits, string_interner=string_interner)
+        ast, stats = profile_ast_from_file(in_file, limits, string_interner)
 
-    raw_contents = raw_contents.decode('zlib')
-    data, stmts = magic.safe_loads(raw_contents, class_factory, {"_ast", "collections"})
-    return stmts
+    with printlock:
+        print("Unpickling profile of %s:" % input_filename)
+        print(stats.summary())
+        if string_interner is not None:
+            print(interner_summary(string_interner))
+    return ast
+
+def interner_summary(string_interner):
+    if string_interner.saved is None:
+        # the interpreter can't tell the size of objects
+        return "Interned %d duplicate strings and locations" % string_interner.hits
+    return "Interned %d duplicate strings and locations, saving %d bytes" % (
+        string_interner.hits, string_interner.saved)
 
 def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python=False,
-                   comparable=False, no_pyexpr=False, translator=None, init_offset=False):
+                   comparable=False, no_pyexpr=False, translator=None, init_offset=False,
+                   profile=False, limits=None, processes=1, source_map=False,
+                   intern_strings=False, stream=False):
     # Output filename is input filename but with .rpy extension
     filepath, ext = path.splitext(input_filename)
     if dump:
@@ -125,49 +532,103 @@ def decompile_rpyc(input_filename, overwrite=False, dump=False, decompile_python
             print("Output file already exists. Pass --clobber to overwrite.")
             return False # Don't stop decompiling if one file already exists
 
-    with open(input_filename, 'rb') as in_file:
-        ast = read_ast_from_file(in_file)
+    ast = read_ast(input_filename, profile, limits, intern_strings)
+    nodes = [] if source_map and not dump else None
 
     with codecs.open(out_filename, 'w', encoding='utf-8') as out_file:
         if dump:
             astdump.pprint(out_file, ast, decompile_python=decompile_python, comparable=comparable,
                                           no_pyexpr=no_pyexpr)
         else:
-            decompiler.pprint(out_file, ast, decompile_python=decompile_python, printlock=printlock,
-                                             translator=translator, init_offset=init_offset)
+            line_count = decompiler.pprint(out_file, ast, decompile_python=decompile_python, printlock=printlock,
+                                             translator=translator, init_offset=init_offset, processes=processes,
+                                             stream=stream, source_map=nodes)
+    if nodes is not None:
+        with open(out_filename + ".map", 'wb') as map_file:
+            sourcemap.write_source_map(map_file, nodes, line_count)
     return True
 
-def extract_translations(input_filename, language):
+def extract_translations(input_filename, language, profile=False, limits=None):
     with printlock:
         print("Extracting translations from %s..." % input_filename)
 
-    with open(input_filename, 'rb') as in_file:
-        ast = read_ast_from_file(in_file)
+    ast = read_ast(input_filename, profile, limits)
 
     translator = translate.Translator(language, True)
     translator.translate_dialogue(ast)
     # we pickle and unpickle this manually because the regular unpickler will choke on it
     return magic.safe_dumps(translator.dialogue), translator.strings
 
+def load_translations(data, limits=None):
+    # Loads a translation file in the pickle format, see --write-translation-file
+    max_size, limits = split_limits(limits)
+    if max_size is not None and len(data) > max_size:
+        raise magic.UnpicklingLimitError(
+            "Translation file is larger than the limit of %d bytes" % max_size)
+    return magic.safe_loads(data, class_factory, {"_ast", "collections"}, encoding="utf-8",
+                            errors="surrogateescape", **limits)
+
+def load_indexed_translations(filename, limits=None):
+    with open(filename, 'rb') as in_file:
+        contents = map_file(in_file)
+    # the blocks of the file are pickles on their own, every one gets the limits
+    return translate.IndexedTranslations(contents, lambda data: load_translations(data, limits))
+
 def worker(t):
     (args, filename, filesize) = t
     try:
+        limits = {}
+        if args.max_size is not None:
+            limits["max_size"] = args.max_size << 20
+        for limit in ("max_objects", "max_length", "max_depth"):
+            if getattr(args, limit) is not None:
+                limits[limit] = getattr(args, limit)
+
         if args.write_translation_file:
-            return extract_translations(filename, args.language)
+            return extract_translations(filename, args.language, args.profile_unpickling, limits)
         else:
-            if args.translation_file is not None:
+            translations = None
+            if args.translation_file is None:
+                translator = None
+            elif args.translations is None:
+                # indexed translation files are mapped by every worker, and only read where needed
+                translations = load_indexed_translations(args.translation_file, limits)
                 translator = translate.Translator(None)
-                translator.language, translator.dialogue, translator.strings = magic.loads(args.translations, class_factory)
+                translator.language, translator.dialogue, translator.strings = (
+                    translations.language, translations.dialogue, translations.strings)
             else:
-                translator = None
-            return decompile_rpyc(filename, args.clobber, args.dump, decompile_python=args.decompile_python,
-                                  no_pyexpr=args.no_pyexpr, comparable=args.comparable, translator=translator, init_offset=args.init_offset)
+                translator = translate.Translator(None)
+                translator.language, translator.dialogue, translator.strings = load_translations(
+                    args.translations, limits)
+            try:
+                return decompile_rpyc(filename, args.clobber, args.dump, decompile_python=args.decompile_python,
+                                      no_pyexpr=args.no_pyexpr, comparable=args.comparable, translator=translator, init_offset=args.init_offset,
+                                      profile=args.profile_unpickling, limits=limits,
+                                      processes=block_processes(args, filesize),
+                                      source_map=args.source_map, intern_strings=args.intern_strings,
+                                      stream=args.stream)
+            finally:
+                if translations is not None:
+                    translations.close()
     except Exception as e:
         with printlock:
             print("Error while decompiling %s:" % filename)
             print(traceback.format_exc())
         return False
 
+def block_processes(args, filesize):
+    # The number of processes splitting up the decompilation of a single file
+    if args.parallel_blocks and filesize >= PARALLEL_BLOCKS_MIN_SIZE:
+        return int(args.processes)
+    return 1
+
+def profiling_worker(t):
+    # Like worker, but also returns the time spent in each decompiler handler for the file
+    profile = util.profile_handlers((decompiler.Decompiler, screendecompiler.SLDecompiler,
+                                     sl2decompiler.SL2Decompiler, testcasedecompiler.TestcaseDecompiler))
+    result = worker(t)
+    return result, profile.take()
+
 def sharelock(lock):
     global printlock
     printlock = lock
@@ -194,6 +655,12 @@ def main():
     parser.add_argument('-l', '--language', dest='language', action='store', default='english',
                         help="if writing a translation file, the language of the translations to write")
 
+    parser.add_argument('--translation-format', dest='translation_format', action='store', default='pickle',
+                        choices=('pickle', 'indexed'),
+                        help="if writing a translation file, its format. 'indexed' files are larger, but only the "
+                        "translations that are needed are loaded from them, which is faster for big games. "
+                        "Either format can be passed to -t")
+
     parser.add_argument('--sl1-as-python', dest='decompile_python', action='store_true',
                         help="Only dumping and for decompiling screen language 1 screens. "
                         "Convert SL1 Python AST to Python code instead of dumping it or converting it to screenlang.")
@@ -212,6 +679,48 @@ def main():
                         "This is always safe to enable if the game's Ren'Py version supports init offset statements, "
                         "and the generated code is exactly equivalent, only less cluttered.")
 
+    parser.add_argument('--parallel-blocks', dest='parallel_blocks', action='store_true',
+                        help="split each file of at least %d KiB into chunks of top-level blocks which are "
+                        "decompiled by -p processes at once. Such files are decompiled one by one, the "
+                        "smaller ones still in parallel with each other. Faster when most of a game is in "
+                        "a few huge files. Only on platforms that can fork processes" % (PARALLEL_BLOCKS_MIN_SIZE >> 10))
+
+    parser.add_argument('--source-map', dest='source_map', action='store_true',
+                        help="also write a .rpy.map file next to every decompiled file, which links each "
+                        "line of it to the AST node printed there, with its original line number and label")
+
+    parser.add_argument('--intern-strings', dest='intern_strings', action='store_true',
+                        help="share repeated strings and (filename, line) locations in the AST of each file while "
+                        "loading it. This saves memory on huge files, but makes loading them slower. "
+                        "--profile-unpickling reports how much it saved")
+
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help="write out the top-level statements of each file as soon as they're decompiled, "
+                        "and free them after that. This lowers the memory use on huge files. "
+                        "Files split up by --parallel-blocks aren't streamed")
+
+    parser.add_argument('--profile-unpickling', dest='profile_unpickling', action='store_true',
+                        help="print statistics about the unpickling of each file: how often every pickle opcode occurs, "
+                        "how many objects of each class are created and how long it took. This makes loading slower")
+
+    parser.add_argument('--profile-handlers', dest='profile_handlers', action='store_true',
+                        help="print how often the decompiler handled every type of AST node, and how much time "
+                        "that took including and excluding nested nodes, summed over all files")
+
+    parser.add_argument('--max-size', dest='max_size', action='store', type=int, default=None,
+                        help="refuse files which decompress to more than the specified number of MiB. "
+                        "Together with the other limits this protects against malicious files")
+
+    parser.add_argument('--max-objects', dest='max_objects', action='store', type=int, default=None,
+                        help="refuse files whose AST consists of more than the specified number of objects")
+
+    parser.add_argument('--max-length', dest='max_length', action='store', type=int, default=None,
+                        help="refuse files with lists, tuples, dicts or sets longer than the specified length")
+
+    parser.add_argument('--max-depth', dest='max_depth', action='store', type=int, default=None,
+                        help="refuse files whose AST nests deeper than the specified depth. "
+                        "Setting any of --max-objects, --max-length and --max-depth makes loading slower")
+
     parser.add_argument('file', type=str, nargs='+',
                         help="The filenames to decompile. "
                         "All .rpyc files in any directories passed or their subdirectories will also be decompiled.")
@@ -225,7 +734,12 @@ def main():
 
     if args.translation_file:
         with open(args.translation_file, 'rb') as in_file:
-            args.translations = in_file.read()
+            if translate.is_indexed_translations(in_file.read(len(translate.INDEXED_MAGIC))):
+                # the workers map indexed files themselves
+                args.translations = None
+            else:
+                in_file.seek(0)
+                args.translations = in_file.read()
 
     # Expand wildcards
     def glob_or_complain(s):
@@ -233,7 +747,7 @@ def main():
         if not retval:
             print("File not found: " + s)
         return retval
-    filesAndDirs = map(glob_or_complain, args.file)
+    filesAndDirs = [glob_or_complain(i) for i in args.file]
     # Concatenate lists
     filesAndDirs = list(itertools.chain(*filesAndDirs))
 
@@ -252,19 +766,37 @@ def main():
         print("No script files to decompile.")
         return
 
-    files = map(lambda x: (args, x, path.getsize(x)), files)
+    files = [(args, x, path.getsize(x)) for x in files]
     processes = int(args.processes)
-    if processes > 1:
+    work = profiling_worker if args.profile_handlers else worker
+    # Files split into blocks use all processes themselves, so they're decompiled one by one
+    # before the pool for the others is started
+    split = sorted((i for i in files if block_processes(args, i[2]) > 1), key=itemgetter(1))
+    files = [i for i in files if block_processes(args, i[2]) <= 1]
+    results = [work(i) for i in split]
+    if processes > 1 and files:
         # If a big file starts near the end, there could be a long time with
         # only one thread running, which is inefficient. Avoid this by starting
         # big files first.
         files.sort(key=itemgetter(2), reverse=True)
-        results = Pool(int(args.processes), sharelock, [printlock]).map(worker, files, 1)
+        pool = Pool(processes, sharelock, [printlock])
+        try:
+            results.extend(pool.map(work, files, 1))
+        finally:
+            # Don't rely on reference counting to shut the workers down, since
+            # interpreters like PyPy only collect the pool much later.
+            pool.close()
+            pool.join()
     else:
         # Decompile in the order Ren'Py loads in
         files.sort(key=itemgetter(1))
-        results = map(worker, files)
+        results.extend(work(i) for i in files)
 
+    if args.profile_handlers:
+        profile = util.HandlerProfile()
+        for result, stats in results:
+            profile.update(stats)
+        results = [result for result, stats in results]
     if args.write_translation_file:
         print("Writing translations to %s..." % args.write_translation_file)
         translated_dialogue = {}
@@ -279,7 +811,12 @@ def main():
             translated_dialogue.update(magic.loads(result[0], class_factory))
             translated_strings.update(result[1])
         with open(args.write_translation_file, 'wb') as out_file:
-            magic.safe_dump((args.language, translated_dialogue, translated_strings), out_file)
+            if args.translation_format == 'indexed':
+                # protocol 2, so the file can be read by both Python 2 and 3
+                translate.write_indexed_translations(out_file, args.language, translated_dialogue,
+                                                     translated_strings, lambda block: magic.safe_dumps(block, 2))
+            else:
+                magic.safe_dump((args.language, translated_dialogue, translated_strings), out_file)
 
     else:
         # Check per file if everything went well and report back
@@ -293,5 +830,9 @@ def main():
     else:
         print("Decompilation of %d file%s successful, but decompilation of %d file%s failed" % (good, 's' if good>1 else '', bad, 's' if bad>1 else ''))
 
+    if args.profile_handlers:
+        print("Time spent in the decompiler handlers of all files:")
+        print(profile.summary())
+
 if __name__ == '__main__':
     main()